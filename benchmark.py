@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# benchmarks the 401k analysis pipeline on synthetic QFX files and price histories
+# runs fully offline: the settings file and GetStockData are replaced by synthetic stand-ins
+from stockanalysis import helpers
+from stockanalysis import getstockdata as gd
+
+import argparse
+import contextlib
+import datetime as dt
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+import pandas as pd
+
+import pricecache
+import projectretirement as projection
+import retirementportfolio as rt
+import simulatePortfolioAllocation as simulate
+
+
+# [years of contributions, funds in the portfolio, tickers to compare with]
+SCALES = {'small': [3, 5, 20],
+          'medium': [10, 10, 200],
+          'large': [20, 20, 1000]}
+
+
+def getargs():
+    # parse command-line arguments using argparse()
+    description = "Benchmark the portfolio pipeline on synthetic data."
+    epilog = "./benchmark.py -s small medium -o bench.json -c previous.json"
+    parser = argparse.ArgumentParser(description=description, epilog=epilog)
+    parser.add_argument('-s', '--scales', help='Scales to run [Default=small]', nargs='+', default=['small'],
+                        choices=list(SCALES))
+    parser.add_argument('-r', '--repeat', help='Repetitions per case, the fastest is kept [Default=3]', type=int,
+                        default=3)
+    parser.add_argument('-o', '--output', help='Write the results as JSON to this file', type=str)
+    parser.add_argument('-c', '--compare', help='Compare with the JSON results of an earlier run', type=str)
+    args = parser.parse_args()
+    return args
+
+
+class SyntheticStockData:
+    """Stand-in for GetStockData that reads the synthetic price files written by genprices()"""
+
+    def __init__(self, ticker, path=None, fetchincompletedata=True, verbose=False):
+        self.ticker = ticker
+        self.df_yahoo = pd.DataFrame()
+        stockfile = os.path.join(path, ticker + '.csv')
+        if os.path.exists(stockfile):
+            self.df = pd.read_csv(stockfile, index_col='Date', parse_dates=['Date'])
+        else:
+            self.df = pd.DataFrame(columns=['Close', 'Volume'], index=pd.DatetimeIndex([], name='Date'))
+
+    def getdata(self, startdate, enddate):
+        return self.df.loc[startdate:enddate]
+
+
+def genprices(stockdata, tickers, startdate, enddate, seed=0):
+    """
+    Writes a geometric random walk of daily Close prices for every ticker to <stockdata>/<ticker>.csv
+    :return: dfprices as a Date x ticker matrix
+    """
+
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(startdate, enddate, name='Date')
+    logreturns = rng.normal(0.0003, 0.012, (len(dates), len(tickers)))
+    prices = np.round(rng.uniform(10, 200, len(tickers)) * np.exp(np.cumsum(logreturns, axis=0)), 4)
+    dfprices = pd.DataFrame(prices, index=dates, columns=tickers)
+
+    for tickr in tickers:
+        df = dfprices[[tickr]].rename(columns={tickr: 'Close'})
+        df['Volume'] = 1000
+        df.to_csv(os.path.join(stockdata, tickr + '.csv'))
+
+    return dfprices
+
+
+def genqfx(qfx_file, year, dfprices, funds, contrib=1000.0):
+    """
+    Writes one year of biweekly contributions split evenly across funds, with quarterly reinvested dividends,
+    as an OFX 1.x (SGML) quicken file
+    """
+
+    paydays = dfprices.loc[str(year)].index[::10]
+    transactions = []
+    for i, payday in enumerate(paydays):
+        for j, fund in enumerate(funds):
+            price = dfprices.loc[payday, fund]
+            units = np.round(contrib / len(funds) / price, 4)
+            memo, aggregate = 'Contribution', 'BUYMF'
+            if i % 6 == 5:
+                memo, aggregate, units = 'Dividends and Earnings', 'REINVEST', np.round(units / 4, 4)
+            fitid = str(year) + str(i).zfill(4) + str(j).zfill(3)
+            invtran = ('<INVTRAN><FITID>' + fitid + '<DTTRADE>' + payday.strftime('%Y%m%d') + '<DTSETTLE>' +
+                       payday.strftime('%Y%m%d') + '120000.000[-5:EST]<MEMO>' + memo + '</INVTRAN>')
+            secid = '<SECID><UNIQUEID>' + str(100000000 + j) + '<UNIQUEIDTYPE>CUSIP</SECID>'
+            amounts = ('<UNITS>' + str(units) + '<UNITPRICE>' + str(price) + '<TOTAL>' +
+                       str(-np.round(units * price, 2)) + '<SUBACCTSEC>OTHER')
+            if aggregate == 'BUYMF':
+                transactions.append('<BUYMF><INVBUY>' + invtran + secid + amounts +
+                                    '<SUBACCTFUND>OTHER</INVBUY><BUYTYPE>BUY</BUYMF>')
+            else:
+                transactions.append('<REINVEST>' + invtran + secid + '<INCOMETYPE>DIV' + amounts + '</REINVEST>')
+
+    securities = ''.join('<MFINFO><SECINFO><SECID><UNIQUEID>' + str(100000000 + j) +
+                         '<UNIQUEIDTYPE>CUSIP</SECID><SECNAME>' + fund + ' Fund<TICKER>' + fund +
+                         '</SECINFO></MFINFO>' for j, fund in enumerate(funds))
+
+    header = ['OFXHEADER:100', 'DATA:OFXSGML', 'VERSION:102', 'SECURITY:NONE', 'ENCODING:USASCII', 'CHARSET:1252',
+              'COMPRESSION:NONE', 'OLDFILEUID:NONE', 'NEWFILEUID:NONE', '']
+    body = ('<OFX><SIGNONMSGSRSV1><SONRS><STATUS><CODE>0<SEVERITY>INFO</STATUS><DTSERVER>' + str(year) +
+            '1231<LANGUAGE>ENG</SONRS></SIGNONMSGSRSV1><INVSTMTMSGSRSV1><INVSTMTTRNRS><TRNUID>1<STATUS><CODE>0'
+            '<SEVERITY>INFO</STATUS><INVSTMTRS><DTASOF>' + str(year) + '1231<CURDEF>USD<INVACCTFROM>'
+            '<BROKERID>example.com<ACCTID>401k</INVACCTFROM><INVTRANLIST><DTSTART>' + str(year) + '0101<DTEND>' +
+            str(year) + '1231' + '\n'.join(transactions) + '</INVTRANLIST></INVSTMTRS></INVSTMTTRNRS>'
+            '</INVSTMTMSGSRSV1><SECLISTMSGSRSV1><SECLIST>' + securities + '</SECLIST></SECLISTMSGSRSV1></OFX>')
+
+    with open(qfx_file, 'w') as f:
+        f.write('\n'.join(header) + '\n' + body + '\n')
+
+
+def genfixtures(root, years, nfunds, ntickers, seed=0):
+    """
+    Creates the directory layout of the settings file under root with synthetic QFX files, price histories,
+    fund allocation, portfolio value and contribution limit tables
+    :return: settings, list of comparison tickers
+    """
+
+    settings = {'data_dir': root + '/', 'input_dir': root + '/datainput/', 'output_dir': root + '/dataoutput/',
+                'stockdata': root + '/stockdata/', 'mykplandata_dir': root + '/mykplan/'}
+    for d in settings.values():
+        os.makedirs(d, exist_ok=True)
+    settings['401kexport'] = settings['output_dir'] + '401kexport.csv'
+    settings['fund_prices_history'] = settings['output_dir'] + 'fund_prices_history.csv'
+    settings['portfoliovalue'] = settings['output_dir'] + 'portfoliovalue.csv'
+    settings['portfolio_allocation_history'] = settings['output_dir'] + 'portfolio_allocation_history.csv'
+
+    funds = ['F' + str(j).zfill(3) for j in range(nfunds)]
+    tickers = ['E' + str(k).zfill(4) for k in range(ntickers)]
+    lastyear = dt.date.today().year - 1
+    firstyear = lastyear - years + 1
+    dfprices = genprices(settings['stockdata'], funds + tickers + ['SPY'], str(firstyear) + '-01-01',
+                         str(lastyear) + '-12-31', seed)
+
+    for year in range(firstyear, lastyear + 1):
+        genqfx(settings['mykplandata_dir'] + str(year) + '.qfx', year, dfprices, funds)
+
+    allocation = np.full(nfunds, 100 // nfunds)
+    allocation[0] += 100 - allocation.sum()
+    pd.DataFrame({'fund_name': [f + ' Fund' for f in funds], 'funds': funds, 'allocation': allocation}).to_csv(
+        settings['input_dir'] + 'mutual-funds-available-in-mykplan.csv', index=False)
+
+    pd.DataFrame({'Date': [dt.date.today().strftime('%m/%d/%Y')],
+                  'PortfolioValue401k': [1000.0 * 26 * years * 1.3]}).to_csv(settings['portfoliovalue'], index=False)
+    pd.DataFrame({'Year': [dt.date.today().year], 'Contrib': [23000]}).to_csv(root + '/maxcontrib.csv', index=False)
+
+    return settings, tickers
+
+
+def timeit(func, repeat):
+    """Runs func repeat times with stdout silenced and returns the fastest time in seconds"""
+
+    best = np.inf
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def runscale(scale, repeat):
+    """Generates the fixtures of a scale and times every stage of the pipeline on them"""
+
+    years, nfunds, ntickers = SCALES[scale]
+    results = []
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as root:
+        settings, tickers = genfixtures(root, years, nfunds, ntickers)
+
+        # run offline: synthetic settings and prices, fresh price cache
+        helpers.load_settings_stocks = lambda: settings
+        gd.GetStockData = SyntheticStockData
+        pricecache.dirs.clear()
+        pricecache.memorycache.clear()
+        rt.filecache.clear()
+        os.chdir(root)
+
+        def coldimport():
+            for f in os.listdir(settings['output_dir']):
+                if f.startswith('401kexport'):
+                    os.remove(settings['output_dir'] + f)
+            return rt.Retirementportfolio(importquicken=True, verbose=False)
+
+        def uncached(method):
+            # replacing rawdata drops the cached derived tables
+            def func():
+                portfolio.rawdata = portfolio.rawdata
+                return method()
+            return func
+
+        def sweep():
+            pricecache.memorycache.clear()
+            return portfolio.getreturns(dfcontrib, tickers, fetchincompletedata=False)
+
+        try:
+            cases = [('importquicken_cold', coldimport),
+                     ('importquicken_unchanged', lambda: rt.Retirementportfolio(importquicken=True, verbose=False))]
+            portfolio = rt.Retirementportfolio(importquicken=True, verbose=False)
+            dfcontrib = portfolio.gencontrib()
+            allocs = pd.read_csv(settings['input_dir'] + 'mutual-funds-available-in-mykplan.csv')
+            cases += [('gencontrib', uncached(portfolio.gencontrib)),
+                      ('gencontrib_cached', portfolio.gencontrib),
+                      ('getdividends', uncached(portfolio.getdividends)),
+                      ('summary', portfolio.summary),
+                      ('holdings', uncached(portfolio.holdings)),
+                      ('compare_sweep', sweep),
+                      ('nav_full', lambda: portfolio.getnav(fetchincompletedata=False, update=False)),
+                      ('nav_update', lambda: portfolio.getnav(fetchincompletedata=False)),
+                      ('simportfolio', lambda: simulate.simportfolio(argparse.Namespace(
+                          verbose=False, fetchincompletedata=False, ticker='SPY', history=False))),
+                      ('projection', lambda: projection.projectretirement(
+                          portfolio, list(allocs['funds']), allocs['allocation'].to_numpy(dtype='float') / 100,
+                          history=years))]
+
+            for case, func in cases:
+                try:
+                    seconds = timeit(func, repeat)
+                    error = None
+                except Exception as e:
+                    seconds = None
+                    error = type(e).__name__ + ": " + str(e)
+                results.append({'scale': scale, 'case': case, 'seconds': seconds, 'error': error,
+                                'years': years, 'funds': nfunds, 'tickers': ntickers,
+                                'transactions': len(portfolio.rawdata)})
+                print(scale.ljust(8), case.ljust(25),
+                      error if error else (str(np.round(seconds * 1000, 1)) + " ms"))
+        finally:
+            os.chdir(cwd)
+
+    return results
+
+
+def gitcommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def compare(results, previousfile):
+    """Prints the ratio of every timing to the same case of an earlier run"""
+
+    with open(previousfile) as f:
+        previous = json.load(f)
+    before = {(res['scale'], res['case']): res['seconds'] for res in previous['results']}
+
+    print("\nCompared with " + previous.get('commit', '') + " (" + previousfile + ")")
+    for res in results:
+        old = before.get((res['scale'], res['case']))
+        if old and res['seconds']:
+            print(res['scale'].ljust(8), res['case'].ljust(25), str(np.round(res['seconds'] / old, 2)) + "x")
+
+
+def main():
+    args = getargs()
+
+    results = []
+    for scale in args.scales:
+        results.extend(runscale(scale, args.repeat))
+
+    report = {'commit': gitcommit(), 'timestamp': dt.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Results written to: " + args.output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ from stockanalysis import helpers
 from stockanalysis import getstockdata as gd
 
 import time
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 import retirementportfolio as rt
 import pandas as pd
@@ -19,6 +20,7 @@ def getargs(description="Compare portfolio performance with all ETFs"):
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('-v', '--verbose', help='Verbose mode [Default=Off]', action='store_true')
     parser.add_argument('-s', '--summary', help='Display summary and exit', action='store_true')
+    parser.add_argument('-w', '--workers', help='Number of worker processes [Default=1]', type=int, default=1)
     args = parser.parse_args()
     return args
 
@@ -37,6 +39,44 @@ def sleepy(x=np.random.randint(1)):
     time.sleep(x+np.random.randint(2))
 
 
+# portfolio and contributions handed to every worker process once by initworker()
+workerportfolio = None
+workerdfcontrib = None
+
+
+def initworker(portfolio, dfcontrib):
+    global workerportfolio, workerdfcontrib
+    workerportfolio = portfolio
+    workerdfcontrib = dfcontrib
+
+
+def shardreturns(tickers):
+    return workerportfolio.getreturns(workerdfcontrib, tickers, fetchincompletedata=False)
+
+
+def iterreturns(portfolio, dfcontrib, tickerlist, workers=1):
+    """
+    Yields the returns of the tickers in tickerlist as dataframes, in the order of tickerlist.
+    With workers > 1 the list is split into shards that are processed by a pool of worker processes
+    """
+
+    tickerlist = list(tickerlist)
+    if workers <= 1:
+        yield portfolio.getreturns(dfcontrib, tickerlist, fetchincompletedata=False, progress=True)
+        return
+
+    # a few shards per worker keeps the workers busy and the progress bar moving
+    shardsize = max(1, int(np.ceil(len(tickerlist) / (workers * 4))))
+    shards = [tickerlist[i:i + shardsize] for i in range(0, len(tickerlist), shardsize)]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initworker,
+                             initargs=(portfolio, dfcontrib)) as executor, tqdm(total=len(tickerlist)) as progress:
+        # map() returns the shards in order as soon as each one is done
+        for shard, df in zip(shards, executor.map(shardreturns, shards)):
+            progress.update(len(shard))
+            yield df
+
+
 def main(args):
     # -------------------------- MAIN MODULE --------------------------
 
@@ -64,22 +104,15 @@ def main(args):
     # exit(0)
     # smaller list for testing purposes
     # tickerlist = ['SPY', 'QQQ', 'IWM']
-    portfolioreturns = []
-    for tickr in tqdm(tickerlist):
-        # if verbose:
-        #     print("Working on", tickr)
-        ret = portfolio.getreturn(dfcontrib, tickr, fetchincompletedata=False)
-        if len(ret) > 2:        # if len(ret) < 2 then error: no ticker data
-            portfolioreturns.append(ret)
-            # print(ret)
-
-        # sleepy(5)
-
-    df = pd.DataFrame(portfolioreturns, columns=['ticker', 'excessreturn', 'yoyreturn', 'totreturn'])
-
-    # save comparison with ETFs to file
+    # prices of all tickers are loaded once and the returns are computed in a single pass
+    # tickers without data are left out
+    # save comparison with ETFs to file as the results come in
     comparereturnsfile = outputdir + 'comparereturns.csv'
-    df.to_csv(comparereturnsfile, index=False)
+    dfs = []
+    for df in iterreturns(portfolio, dfcontrib, tickerlist, workers=args.workers):
+        df.to_csv(comparereturnsfile, index=False, mode='a' if len(dfs) > 0 else 'w', header=len(dfs) == 0)
+        dfs.append(df)
+    df = pd.concat(dfs, ignore_index=True)
     print("Comparisons are saved to " + comparereturnsfile)
 
     # filter our non-performers keeping excess return ones and compare their growth w.rt. to your portfolio growth
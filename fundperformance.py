@@ -1,66 +1,283 @@
 #!/usr/bin/env python3
+import argparse
 import os
 import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
+import pricecache
 import retirementportfolio as rt
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from stockanalysis import helpers
-from stockanalysis import getstockdata as gd
 import datetime as dt
 
 
+TRADINGDAYS = 252
+METRICS = ['return', 'cagr', 'volatility', 'maxdrawdown', 'sharpe', 'medianrolling', 'worstrolling',
+           'medianrollingvol', 'worstrollingvol']
+
+
+def getargs():
+    # parse command-line arguments using argparse()
+    description = "Compare the performance of the funds available in the 401k plan"
+    epilog = "./fundperformance.py -w 1 3 5 -s sharpe"
+    parser = argparse.ArgumentParser(description=description, epilog=epilog)
+    parser.add_argument('-y', '--years', help='Years of price history to keep in fund_performance.csv [Default=5]',
+                        type=int, default=5)
+    parser.add_argument('-w', '--windows', help='Trailing windows in years [Default=1 3 5]', type=int, nargs='+',
+                        default=[1, 3, 5])
+    parser.add_argument('-r', '--riskfree', help='Annual risk free rate for the Sharpe ratio [Default=0]',
+                        type=float, default=0.0)
+    parser.add_argument('-s', '--sort', help='Metric to sort and plot the funds by [Default=return]', type=str,
+                        default='return', choices=METRICS)
+    parser.add_argument('-n', '--noplot', help='Do not plot [Default=Off]', action='store_true')
+    args = parser.parse_args()
+    return args
+
+
 def r(n):
     return np.round(n, 2)
 
 
-def fundperf(allocs):
+def loadpanel(tickers, startdate, enddate, workers=8):
+    """
+    Loads the Close prices of several tickers into one float matrix indexed by the union of their dates.
+    Tickers are read concurrently through the price cache; days a ticker did not trade are NaN
+    :param tickers:
+    :param startdate:
+    :param enddate:
+    :param workers: number of tickers read at the same time
+    :return: df
+    """
+
+    tickers = list(tickers)
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(tickers)))) as executor:
+        closes = list(executor.map(lambda tickr: pricecache.getclose(tickr, startdate, enddate), tickers))
+
+    dates = np.unique(np.concatenate([close.index.values for close in closes])) if len(closes) > 0 else []
+    dates = pd.DatetimeIndex(dates, name='Date')
+
+    panel = np.full((len(dates), len(tickers)), np.nan)
+    for col, close in enumerate(closes):
+        panel[dates.get_indexer(close.index), col] = close.to_numpy(dtype=float)
+
+    return pd.DataFrame(r(panel), index=dates, columns=tickers)
+
+
+def fundperf(allocs, years=3, dfprevious=None, workers=8):
+    """
+    Close prices of the funds in allocs over the last years, one column per fund.
+    With dfprevious (a previous result) only its last day and the days after it are loaded for the funds it already
+    has; funds it does not have are loaded in full. Rows older than the window are dropped
+    :param allocs: DataFrame with a 'funds' column
+    :param years:
+    :param dfprevious:
+    :param workers:
+    :return: df
+    """
+
+    # the same calendar offset as the trailing windows, with a few days of margin for weekends and holidays, so the
+    # longest window fits in the panel
+    enddate = dt.datetime.today()
+    startdate = enddate - pd.DateOffset(years=years) - dt.timedelta(days=7)
+    funds = list(allocs['funds'])
+
+    if dfprevious is not None and len(dfprevious) > 0:
+        dfprevious = dfprevious.copy()
+        dfprevious.index = pd.DatetimeIndex(dfprevious.index, name='Date')
+        # a previous result over a shorter window cannot be extended backwards
+        if dfprevious.index.min() > startdate + dt.timedelta(days=7):
+            dfprevious = None
+
+    if dfprevious is None or len(dfprevious) == 0:
+        return loadpanel(funds, startdate, enddate, workers)
+
+    known = [tickr for tickr in funds if tickr in dfprevious.columns]
+    new = [tickr for tickr in funds if tickr not in dfprevious.columns]
+
+    df = dfprevious[known]
+    if len(known) > 0:
+        # the last stored day is loaded again: a fund may have had no price yet when it was saved
+        df = loadpanel(known, dfprevious.index.max(), enddate, workers).combine_first(df)
+
+    if len(new) > 0:
+        df = df.join(loadpanel(new, startdate, enddate, workers), how='outer')
+
+    df = df.sort_index()
+    return df.loc[df.index >= startdate, funds]
+
+
+def windowstart(dates, years):
+    """Row of the last date at least years before each date in dates, or -1 if the history is shorter"""
+
+    start = dates.searchsorted(dates - pd.DateOffset(years=years), side='right') - 1
+    start[dates - pd.DateOffset(years=years) < dates[0]] = -1
+    return start
+
 
-    startdate, enddate = dt.datetime.today() - dt.timedelta(days=3 * 365), dt.datetime.today()
+def rollingreturns(df, years):
+    """
+    Trailing returns over years calendar years ending on every date of a price panel, in percent. NaN until a fund
+    has years of history
+    :param df: prices, one column per fund
+    :param years:
+    :return: df
+    """
 
-    # create empty dataframe to keep adding the price evolution of each ticker as a column
-    ticker = allocs['funds'].iloc[0]
-    stockobj = gd.GetStockData(ticker)
-    df = stockobj.getdata(startdate, enddate)
-    df = df.rename(columns={'Close': ticker})
-    df = df[[ticker, 'Volume']]
-    # df['Date'] = dfcontrib['Date']
+    prices = df.ffill().to_numpy(dtype=float)
+    start = windowstart(df.index, years)
 
-    for ticker in allocs['funds'][1:]:
-        stockobj = gd.GetStockData(ticker)
-        dftemp = stockobj.getdata(startdate, enddate)
-        df[ticker] = dftemp['Close']
-        # dftemp = dftemp.rename({'Close': ticker})
-        # df.merge(dftemp, left_index=True, right_index=True)
-        # The 'value' column contains the real information
+    rets = np.full(prices.shape, np.nan)
+    valid = start >= 0
+    rets[valid] = (prices[valid] / prices[start[valid]] - 1) * 100
 
-    df = df.drop(columns='Volume')
-    df = df.apply(lambda x: r(x))
-    return df
+    return pd.DataFrame(rets, index=df.index, columns=df.columns)
+
+
+def rollingvolatility(df, years):
+    """
+    Annualised volatility of the daily log returns over years calendar years ending on every date, in percent.
+    Uses running sums of the returns and their squares, so the cost does not depend on the window length. NaN until
+    a fund has years of history
+    :param df: prices, one column per fund
+    :param years:
+    :return: df
+    """
+
+    prices = df.ffill().to_numpy(dtype=float)
+    logret = np.diff(np.log(prices), axis=0, prepend=np.nan)
+    valid = ~np.isnan(logret)
+    logret = np.where(valid, logret, 0.0)
+
+    # running sums with a leading row of zeros, so a window (start, end] is sums[end + 1] - sums[start + 1]
+    zeros = np.zeros((1, logret.shape[1]))
+    count = np.vstack([zeros, np.cumsum(valid, axis=0)])
+    total = np.vstack([zeros, np.cumsum(logret, axis=0)])
+    squares = np.vstack([zeros, np.cumsum(logret ** 2, axis=0)])
+
+    start = windowstart(df.index, years)
+    end = np.arange(len(df)) + 1
+    vol = np.full(logret.shape, np.nan)
+    ok = start >= 0
+    n = count[end[ok]] - count[start[ok] + 1]
+    mean = (total[end[ok]] - total[start[ok] + 1]) / np.where(n > 0, n, np.nan)
+    var = (squares[end[ok]] - squares[start[ok] + 1] - n * mean ** 2) / np.where(n > 1, n - 1, np.nan)
+    vol[ok] = np.sqrt(np.clip(var, 0, None) * TRADINGDAYS) * 100
+    # like rollingreturns, a fund without a price at the start of the window has no volatility for it
+    vol[ok] = np.where(np.isnan(prices[start[ok]]), np.nan, vol[ok])
+
+    return pd.DataFrame(vol, index=df.index, columns=df.columns)
+
+
+def windowmetrics(df, years=None, riskfree=0.0):
+    """
+    Return, CAGR, volatility, max drawdown and Sharpe ratio of every fund over the trailing years of a price panel,
+    or over its whole history when years is None. Percentages except for the Sharpe ratio. Funds with a shorter
+    history than the window are NaN
+    :param df: prices, one column per fund
+    :param years:
+    :param riskfree: annual risk free rate in percent
+    :return: df
+    """
+
+    prices = df.ffill()
+    if years is not None:
+        startdate = prices.index[-1] - pd.DateOffset(years=years)
+        if startdate < prices.index[0]:
+            return pd.DataFrame(np.nan, index=df.columns, columns=METRICS[:5])
+        # start from the last price on or before the start of the window
+        prices = prices.iloc[prices.index.searchsorted(startdate, side='right') - 1:]
+    p = prices.to_numpy(dtype=float)
+
+    # first and last price of every fund, funds listed during the window get NaN
+    first = p[0] if years is not None else prices.bfill().to_numpy(dtype=float)[0]
+    last = p[-1]
+    firstdate = prices.index[0] if years is not None else prices.apply(pd.Series.first_valid_index)
+    yrs = np.asarray((prices.index[-1] - pd.DatetimeIndex(np.broadcast_to(firstdate, len(first)))).days) / 365.25
+
+    # all-NaN columns of funds without enough history only give NaN, silence numpy about them
+    with np.errstate(all='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        totreturn = last / first - 1
+        cagr = np.where(yrs > 0, (1 + totreturn) ** (1 / yrs) - 1, np.nan)
+        logret = np.diff(np.log(p), axis=0)
+        vol = np.nanstd(logret, axis=0, ddof=1) * np.sqrt(TRADINGDAYS) if len(logret) > 1 else np.nan * first
+        drawdown = np.nanmin(p / np.fmax.accumulate(p, axis=0) - 1, axis=0)
+        sharpe = (cagr - riskfree / 100) / np.where(vol > 0, vol, np.nan)
+
+    # a fund listed during the window has no metrics for it
+    vol = np.where(np.isnan(first), np.nan, vol)
+    drawdown = np.where(np.isnan(first), np.nan, drawdown)
+
+    return pd.DataFrame({'return': totreturn * 100, 'cagr': cagr * 100, 'volatility': vol * 100,
+                         'maxdrawdown': drawdown * 100, 'sharpe': sharpe}, index=df.columns)
+
+
+def fundmetrics(df, windows=(1, 3, 5), riskfree=0.0):
+    """
+    Performance metrics of every fund over trailing windows and over the whole price panel, one row per fund and
+    window. medianrolling and worstrolling summarise the returns over all windows of the same length in the panel,
+    medianrollingvol and worstrollingvol (the highest) their volatilities
+    :param df: prices, one column per fund
+    :param windows: window lengths in years
+    :param riskfree: annual risk free rate in percent
+    :return: df ['window', 'ticker', 'return', 'cagr', 'volatility', 'maxdrawdown', 'sharpe', 'medianrolling',
+    'worstrolling', 'medianrollingvol', 'worstrollingvol']
+    """
+
+    frames = []
+    for years in list(windows) + [None]:
+        dfwindow = windowmetrics(df, years, riskfree)
+        if years is None:
+            dfwindow[METRICS[5:]] = np.nan
+        else:
+            rolling = rollingreturns(df, years).to_numpy()
+            rollingvol = rollingvolatility(df, years).to_numpy()
+            with np.errstate(all='ignore'), warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                dfwindow['medianrolling'] = np.nanmedian(rolling, axis=0) if len(rolling) > 0 else np.nan
+                dfwindow['worstrolling'] = np.nanmin(rolling, axis=0) if len(rolling) > 0 else np.nan
+                dfwindow['medianrollingvol'] = np.nanmedian(rollingvol, axis=0) if len(rollingvol) > 0 else np.nan
+                dfwindow['worstrollingvol'] = np.nanmax(rollingvol, axis=0) if len(rollingvol) > 0 else np.nan
+        dfwindow.insert(0, 'window', 'max' if years is None else str(years) + 'y')
+        frames.append(dfwindow.rename_axis('ticker').reset_index())
+
+    dfmetrics = pd.concat(frames, ignore_index=True)
+    dfmetrics[METRICS] = r(dfmetrics[METRICS])
+    return dfmetrics[['window', 'ticker'] + METRICS]
 
 
 def main():
+    args = getargs()
+
     fundnames = 'data/datainput/mutual-funds-available-in-mykplan.csv'
     fundperfcsv = 'data/dataoutput/' + 'fund_performance.csv'
+    fundmetricscsv = 'data/dataoutput/' + 'fund_metrics.csv'
 
     allocs = pd.read_csv(fundnames)
 
+    dfprevious = None
     if os.path.exists(fundperfcsv):
-        df = pd.read_csv(fundperfcsv)
-        df = df.set_index('Date')
-    else:
-        df = fundperf(fundnames=allocs, years=3)
-        df.to_csv(fundperfcsv)
+        dfprevious = pd.read_csv(fundperfcsv, index_col='Date', parse_dates=['Date'])
 
-    # df.columns = list(map(lambda x: x.split(" Fund - ")[0], allocs['fund_name']))
-    dfnorm = np.round((df.iloc[-1]/df.iloc[0]-1)*100, 2)
+    years = max([args.years] + args.windows)
+    df = fundperf(allocs, years=years, dfprevious=dfprevious)
+    df.to_csv(fundperfcsv)
 
-    allocs['perf'] = list(dfnorm)
-    print(allocs.sort_values('perf'))
+    dfmetrics = fundmetrics(df, args.windows, args.riskfree)
+    dfmetrics.to_csv(fundmetricscsv, index=False)
+
+    # df.columns = list(map(lambda x: x.split(" Fund - ")[0], allocs['fund_name']))
+    for window, dfwindow in dfmetrics.groupby('window', sort=False):
+        print(window)
+        print(dfwindow.drop(columns='window').sort_values(args.sort).to_string(index=False))
 
-    dfnorm.plot.barh(figsize=(20, 5))
-    plt.show()
+    if not args.noplot:
+        dfplot = dfmetrics.pivot(index='ticker', columns='window', values=args.sort)
+        dfplot[list(dfmetrics['window'].unique())].plot.barh(figsize=(20, 5), title=args.sort)
+        plt.show()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,240 @@
+# this is a module file
+# to keep daily histories as append-only CSV logs. This file is not executable
+#
+# Histories are stored in long format [Date, ticker, value], one row per ticker per day, sorted by date.
+# New days are appended to the end of the file, so the work of a daily update does not depend on the file size.
+# Running an update twice on the same day appends the rows again only if the values changed: readers keep the last
+# row of every (Date, ticker).
+import datetime as dt
+import logging
+import os
+
+import pandas as pd
+
+
+historylogs = logging.getLogger('historylog')
+
+LONGCOLUMNS = ['Date', 'ticker', 'value']
+
+
+def longstore(widefile):
+    """Path of the long-format log kept next to a wide history file (one column per day)"""
+    return os.path.splitext(widefile)[0] + '_long.csv'
+
+
+def taillines(filename, blocksize=4096):
+    """Yields the lines of a file from the last to the first, reading blocks from the end of the file"""
+
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        rest = b''
+        while position > 0:
+            readsize = min(blocksize, position)
+            position -= readsize
+            f.seek(position)
+            lines = (f.read(readsize) + rest).split(b'\n')
+            # the first line may continue in the previous block
+            rest = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip():
+                    yield line.decode('utf-8')
+        if rest.strip():
+            yield rest.decode('utf-8')
+
+
+def repairtail(filename):
+    """
+    Makes sure a log ends with a newline before appending to it. appendlines ends every line with a newline, so a
+    last line without one is a partly written line left behind by a crash during an append: it is cut off and kept
+    in <filename>.torn for inspection
+    """
+
+    with open(filename, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+
+        # scan back to the end of the last complete line
+        position = size
+        newline = -1
+        while position > 0:
+            readsize = min(4096, position)
+            position -= readsize
+            f.seek(position)
+            newline = f.read(readsize).rfind(b'\n')
+            if newline >= 0:
+                break
+        end = position + newline + 1 if newline >= 0 else 0
+
+        # a file holding only its header: add the missing newline
+        if end == 0:
+            f.seek(0, os.SEEK_END)
+            f.write(b'\n')
+            return
+
+        f.seek(end)
+        torn = f.read()
+        with open(filename + '.torn', 'ab') as ftorn:
+            ftorn.write(torn + b'\n')
+        f.truncate(end)
+
+    historylogs.warning("Cut off the partly written last line of " + filename + ": " +
+                        torn.decode('utf-8', errors='replace'))
+
+
+def lastrow(filename):
+    """
+    Returns the last row of a CSV log as a dict {column: value} without reading the rest of the file, or None when
+    the file only has a header
+    """
+
+    with open(filename, 'r') as f:
+        header = f.readline().strip()
+
+    for line in taillines(filename):
+        if line.strip() == header:
+            return None
+        return dict(zip(header.split(','), line.strip().split(',')))
+
+    return None
+
+
+def appendlines(filename, lines, header):
+    """
+    Appends lines to a log file with a single write. A new file is written completely and then renamed into place,
+    so readers never see a file without its header
+    """
+
+    text = ''.join(line + '\n' for line in lines)
+
+    if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+        with open(filename + '.tmp', 'w') as f:
+            f.write(header + '\n' + text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + '.tmp', filename)
+        return
+
+    repairtail(filename)
+    with open(filename, 'a') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def widetolong(widefile):
+    """
+    Converts a wide history file [ticker, <dd-Mon-YYYY>, ...] to the long format [Date, ticker, value].
+    The wide files filled missing data with 0, so zeros are dropped
+    :param widefile:
+    :return: df
+    """
+
+    df = pd.read_csv(widefile)
+    df = df.melt(id_vars='ticker', var_name='Date', value_name='value')
+    df['Date'] = pd.to_datetime(df['Date'], format='%d-%b-%Y')
+    # values may be stored as scraped, e.g. '12.5%'
+    df['value'] = pd.to_numeric(df['value'].astype(str).str.replace(r'[^\d.\-]', '', regex=True), errors='coerce')
+    df = df[df['value'].notna() & (df['value'] != 0)]
+
+    return df[LONGCOLUMNS].sort_values(['Date', 'ticker'], kind='stable').reset_index(drop=True)
+
+
+def lastday(storefile):
+    """Returns the last date in a long-format log and the {ticker: value} rows stored for it"""
+
+    date = None
+    values = {}
+    for line in taillines(storefile):
+        fields = line.rsplit(',', 2)
+        if fields[0] == 'Date':
+            break
+        if date is None:
+            date = fields[0]
+        elif fields[0] != date:
+            break
+        # walking backwards, so the first row seen for a ticker is the last one written
+        values.setdefault(fields[1], float(fields[2]))
+
+    return date, values
+
+
+def upserthistory(storefile, values, date=None, widefile=None):
+    """
+    Adds the values of one day to a long-format log. Writing the same values twice on a day is a no-op; writing
+    different values on the same day replaces them for readers.
+    On first use the log is created from the wide history file, if there is one
+    :param storefile:
+    :param values: Series of values indexed by ticker
+    :param date: [Default=today]
+    :param widefile:
+    :return: True if rows were written
+    """
+
+    if date is None:
+        date = dt.date.today()
+    date = pd.Timestamp(date).strftime('%Y-%m-%d')
+
+    if not os.path.exists(storefile) and widefile is not None and os.path.exists(widefile):
+        df = widetolong(widefile)
+        df['Date'] = df['Date'].dt.strftime('%Y-%m-%d')
+        df.to_csv(storefile + '.tmp', index=False)
+        os.replace(storefile + '.tmp', storefile)
+
+    values = pd.to_numeric(values, errors='coerce').dropna()
+
+    if os.path.exists(storefile):
+        repairtail(storefile)
+        lastdate, lastvalues = lastday(storefile)
+        if lastdate == date:
+            values = values[[lastvalues.get(tickr) is None or abs(lastvalues[tickr] - v) > 1e-9
+                             for tickr, v in values.items()]]
+
+    if len(values) == 0:
+        return False
+
+    appendlines(storefile, [date + ',' + str(tickr) + ',' + repr(float(v)) for tickr, v in values.items()],
+                header=','.join(LONGCOLUMNS))
+
+    return True
+
+
+def readhistory(storefile, widefile=None):
+    """
+    Reads a long-format log indexed by (Date, ticker), keeping the last row written for every (Date, ticker).
+    Falls back to converting the wide history file when the log does not exist yet
+    :param storefile:
+    :param widefile:
+    :return: df
+    """
+
+    if os.path.exists(storefile):
+        df = pd.read_csv(storefile, parse_dates=['Date'], dtype={'ticker': str})
+    elif widefile is not None and os.path.exists(widefile):
+        df = widetolong(widefile)
+    else:
+        df = pd.DataFrame(columns=LONGCOLUMNS)
+
+    df = df.drop_duplicates(['Date', 'ticker'], keep='last')
+
+    return df.set_index(['Date', 'ticker']).sort_index()
+
+
+def pivothistory(storefile, widefile=None):
+    """
+    Wide view of a long-format log: one row per ticker and one column per day, like the old history files.
+    Missing values are NaN, not 0
+    :param storefile:
+    :param widefile:
+    :return: df
+    """
+
+    df = readhistory(storefile, widefile)['value'].unstack('Date')
+    df.columns = df.columns.strftime('%d-%b-%Y')
+
+    return df.rename_axis(columns=None).reset_index()
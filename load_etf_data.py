@@ -3,13 +3,18 @@ from stockanalysis import helpers
 from stockanalysis import getstockdata as gd
 
 import argparse
+import datetime as dt
 import logging
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pandas as pd
 import numpy as np
 
+import historylog
+import pricecache
 
 
 helpers.initiate_logging()
@@ -22,96 +27,308 @@ def getargs():
     parser.add_argument('-v', '--verbose', help='Verbose mode [Default=Off]', action='store_true')
     parser.add_argument('-f', '--fetchincompletedata', help='fetch incomplete data; when off fetches data iff the '
                                                             'ETF is not on disk [Default=Off]', action='store_true')
+    parser.add_argument('-n', '--dryrun', help='Print the refresh plan and exit [Default=Off]', action='store_true')
+    parser.add_argument('-w', '--workers', help='Number of concurrent downloads [Default=4]', type=int, default=4)
+    parser.add_argument('-r', '--requests', help='Maximum requests per window [Default=30]', type=int, default=30)
+    parser.add_argument('--window', help='Rate limit window in seconds [Default=60]', type=float, default=60)
+    parser.add_argument('--retries', help='Retries per ticker [Default=3]', type=int, default=3)
 
     args = parser.parse_args()
 
     return args
 
 
-def etflist(verbose=True):
-    """Get ETF list"""
+# the ETF list is fetched again when the local copy is older than this
+ETFLISTTTL = dt.timedelta(days=7)
+
+ETFSCREENERURL = 'https://finance.yahoo.com/screener/unsaved/99f6dea0-c683-424a-aab2-8df8f048a60b?offset={0}&count=200'
+
+
+def etflist(verbose=True, ttl=ETFLISTTTL, source=None):
+    """
+    Get ETF list
+    The list is cached in input_dir/etflist.csv and fetched again from Yahoo when the file is older than ttl.
+    A stale file is still used when the fetch fails
+    """
 
     # load configurations from settings file
     settings = helpers.load_settings_stocks()
     inputdir = settings['input_dir']
 
     etflistfile = inputdir + 'etflist.csv'
+    age = None
     if os.path.exists(etflistfile):
+        age = dt.datetime.now() - dt.datetime.fromtimestamp(os.path.getmtime(etflistfile))
+
+    if age is not None and age < ttl:
         if verbose:
             load_etf_data_logs.info("Loading ticker list from file: " + etflistfile)
         dfetf = pd.read_csv(etflistfile)
     else:
         if verbose:
-            load_etf_data_logs.error("Local ETFlist file not found " + etflistfile)
+            if age is None:
+                load_etf_data_logs.error("Local ETFlist file not found " + etflistfile)
+            else:
+                load_etf_data_logs.info("Local ETFlist file is older than " + str(ttl) + " " + etflistfile)
             load_etf_data_logs.info("Loading ticker list from Yahoo:")
-        dfetf = getetfyahoo(verbose)
+        try:
+            dfetf = getetfyahoo(verbose, source=source, etflistfile=etflistfile)
+        except (OSError, ValueError) as error:
+            if age is None:
+                raise
+            load_etf_data_logs.error("Could not fetch the ETF list (" + str(error) + "). Using " + etflistfile)
+            dfetf = pd.read_csv(etflistfile)
 
     tickerlist = dfetf['Symbol']
 
     return tickerlist
 
 
-def getetfyahoo(verbose=True):
-    """Get ETF list from Yahoo"""
-
-    url1 = 'https://finance.yahoo.com/screener/unsaved/99f6dea0-c683-424a-aab2-8df8f048a60b?offset='
-    url2 = '&count=200'
+def getetfyahoo(verbose=True, source=None, pages=5, etflistfile='etflist.csv'):
+    """
+    Get ETF list from Yahoo
+    The screener pages of 200 rows are fetched concurrently and saved together to etflistfile
+    :param verbose:
+    :param source: directory of recorded pages etflist_<offset>.html to read instead of Yahoo, e.g. in tests
+    :param pages:
+    :param etflistfile:
+    :return: dfetf
+    """
 
-    dflist = []
-    for i in range(5):
-        url = url1 + str(i * 200) + url2
+    def getpage(offset):
+        if source is None:
+            url = ETFSCREENERURL.format(offset)
+        else:
+            url = os.path.join(source, 'etflist_' + str(offset) + '.html')
         if verbose:
-            load_etf_data_logs.info("Getting URL: " + url1 + url2)
-        dftemp = pd.read_html(url)
-        dflist.append(dftemp[0])
-        helpers.sleepy(2)
+            load_etf_data_logs.info("Getting URL: " + url)
+        return pd.read_html(url)[0]
+
+    # map() keeps the pages in order
+    with ThreadPoolExecutor(max_workers=pages) as executor:
+        dflist = list(executor.map(getpage, [i * 200 for i in range(pages)]))
 
     dfetf = pd.concat(dflist)
     dfetf = dfetf.reset_index()
     dfetf = dfetf.drop(columns=['index'])
-    dfetf.to_csv('etflist.csv', index=False)
+    dfetf.to_csv(etflistfile + '.tmp', index=False)
+    os.replace(etflistfile + '.tmp', etflistfile)
     return dfetf
 
 
-def getetfdata(tickerlist, fetchincompletedata=False, verbose=True):
-    """Get ETF data from Yahoo"""
+class TokenBucket:
+    """Rate limiter shared by all download threads: at most `requests` requests in any `window` seconds"""
+
+    def __init__(self, requests, window):
+        self.capacity = requests
+        self.tokens = float(requests)
+        self.rate = requests / window
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be made"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def prefetch(tickerlist, fetch, workers=4, requests=30, window=60, retries=3, backoff=2.0, checkpoint=None,
+             verbose=True):
+    """
+    Downloads tickers with a bounded pool of worker threads and a token bucket rate limit.
+    Failed downloads are retried with exponential backoff. Tickers that are done are written to the checkpoint
+    file, so an interrupted run continues where it stopped. The checkpoint is dated and only a checkpoint of the same
+    day is resumed. It is removed when a run finishes, also when some tickers failed, so tickers that always fail do
+    not make later runs skip the others
+    :param tickerlist:
+    :param fetch: function(ticker) that downloads one ticker, e.g. from a local price server in tests
+    :param workers:
+    :param requests: maximum requests per window
+    :param window: seconds
+    :param retries:
+    :param backoff: seconds before the first retry, doubled on every retry
+    :param checkpoint: file with the tickers that are done
+    :param verbose:
+    :return: list of tickers that failed
+    """
+
+    today = dt.date.today().isoformat()
+    done = set()
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            lines = f.read().split('\n')
+        # first line: '# <date of the run>'
+        if lines[0] == '# ' + today:
+            done = set(tickr for tickr in lines[1:] if tickr != '')
+            if verbose:
+                load_etf_data_logs.info("Resuming from checkpoint: " + str(len(done)) + " tickers already done")
+        else:
+            os.remove(checkpoint)
+    todo = [tickr for tickr in tickerlist if tickr not in done]
+
+    bucket = TokenBucket(requests, window)
+
+    checkpointlock = threading.Lock()
+
+    def download(tickr):
+        for attempt in range(retries + 1):
+            bucket.acquire()
+            try:
+                fetch(tickr)
+                # written by the worker, so a download that finishes while the run is interrupted is not lost
+                if checkpointfile is not None:
+                    with checkpointlock:
+                        checkpointfile.write(tickr + '\n')
+                        checkpointfile.flush()
+                return None
+            except Exception as error:
+                if attempt == retries:
+                    return error
+                sleeptime = backoff * 2 ** attempt * np.random.uniform(1, 1.5)
+                if verbose:
+                    load_etf_data_logs.info(tickr + " failed (" + str(error) + "). Retrying in " +
+                                            str(np.round(sleeptime, 1)) + " seconds")
+                time.sleep(sleeptime)
+
+    failed = []
+    checkpointfile = None
+    if checkpoint is not None:
+        newcheckpoint = not os.path.exists(checkpoint)
+        checkpointfile = open(checkpoint, 'a')
+        if newcheckpoint:
+            checkpointfile.write('# ' + today + '\n')
+            checkpointfile.flush()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(download, tickr): tickr for tickr in todo}
+            for count, future in enumerate(as_completed(futures), 1):
+                tickr = futures[future]
+                try:
+                    error = future.result()
+                except BaseException:
+                    # interrupted: do not start the tickers still waiting, they are resumed from the checkpoint
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+                if error is not None:
+                    failed.append(tickr)
+                    load_etf_data_logs.error(tickr + " failed: " + str(error))
+                if verbose:
+                    load_etf_data_logs.info(str(count) + "/" + str(len(todo)) + " " + tickr)
+    finally:
+        if checkpointfile is not None:
+            checkpointfile.close()
+
+    # the run finished: the next run plans again from the stockdata files
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    return failed
+
+
+def laststoreddate(tickr, stockdata):
+    """Last date stored for a ticker, read from the tail of its stockdata file. None when there is no file"""
+
+    names = [name for name, size, mtime in pricecache.stockfilesignature(tickr, stockdata) if size > 0]
+    if len(names) == 0:
+        return None
+
+    lastrow = historylog.lastrow(os.path.join(stockdata, names[0]))
+    if lastrow is None:
+        return None
+    # the date is the first column of the file
+    date = pd.to_datetime(lastrow.get('Date', next(iter(lastrow.values()))), errors='coerce')
+
+    return None if pd.isna(date) else date.normalize()
+
+
+def planrefresh(tickerlist, stockdata, today=None):
+    """
+    Plans the downloads needed to bring the stockdata directory up to date. Tickers that already have the last
+    business day are left out. The others get the date range after their last stored date, most stale first;
+    tickers that are not on disk come first with the full range
+    :param tickerlist:
+    :param stockdata:
+    :param today: [Default=today]
+    :return: dfplan in the format [ticker, laststored, startdate, enddate, staledays]
+    """
+
+    today = pd.Timestamp(today if today is not None else dt.date.today()).normalize()
+    # prices of today are only complete after the close
+    lastbusinessday = today - pd.offsets.BDay(1)
+
+    laststored = pd.Series([laststoreddate(tickr, stockdata) for tickr in tickerlist], index=list(tickerlist),
+                           dtype='datetime64[ns]')
+
+    dfplan = pd.DataFrame({'ticker': laststored.index, 'laststored': laststored.values})
+    dfplan = dfplan[~(dfplan['laststored'] >= lastbusinessday)]
+    dfplan['startdate'] = dfplan['laststored'] + pd.Timedelta(days=1)
+    dfplan['enddate'] = today
+    dfplan['staledays'] = (today - dfplan['laststored']).dt.days.fillna(np.inf)
+
+    return dfplan.sort_values('staledays', ascending=False, kind='stable').reset_index(drop=True)
+
+
+def getetfdata(tickerlist, fetchincompletedata=False, verbose=True, workers=4, requests=30, window=60, retries=3,
+               dryrun=False):
+    """
+    Get ETF data from Yahoo
+    Only tickers that are not on disk are downloaded. With fetchincompletedata stale tickers are also refreshed,
+    each with the date range it is missing
+    """
 
     # load configurations from settings file
     settings = helpers.load_settings_stocks()
     outputdir = settings['stockdata']
 
-    sleepcount = 0
-    randcounterlimit = 50
+    dfplan = planrefresh(tickerlist, outputdir)
+    if not fetchincompletedata:
+        dfplan = dfplan[dfplan['laststored'].isna()]
+
+    if dryrun or verbose:
+        print("Refresh plan: " + str(len(dfplan)) + " of " + str(len(tickerlist)) + " tickers, " +
+              str(int(dfplan['laststored'].isna().sum())) + " not on disk")
+        helpers.printdataframe(dfplan)
+    if dryrun:
+        return []
 
-    for tickr in tickerlist:
+    ranges = {row.ticker: (row.startdate, row.enddate) for row in dfplan.itertuples()}
+
+    def fetch(tickr):
         stock = gd.GetStockData(ticker=tickr, path=outputdir, fetchincompletedata=fetchincompletedata)
+        startdate, enddate = ranges[tickr]
+        if not pd.isna(startdate):
+            stock.getdata(startdate, enddate)
 
-        if len(stock.df_yahoo) > 0:
-            # TODO: there is some bug here stock.df_yahoo is empty even when yfinance fetches data
-            # if data is loaded from Yahoo then sleep randomly to give impression of human activity
-            # if data is NOT loaded from Yahoo then skip sleeping
-            # Every 50-80 URLS sleep for 2-20 mins
-            sleepcount = sleepcount + 1
-            if sleepcount > randcounterlimit:
-                sleepcount = 0
-                randcounterlimit = np.random.randint(50, 80)
-                sleeptime = np.random.randint(2, 5) * 60
-                if verbose:
-                    load_etf_data_logs.info("Sleeping ... " + str(sleeptime / 60) + " mins")
-                helpers.sleepy(sleeptime)
-            else:
-                sleeptime = np.random.randint(3, 7)
-                if verbose:
-                    load_etf_data_logs.info("Sleeping ... " + str(sleeptime) + " seconds")
-                helpers.sleepy(sleeptime)
-        print("-" * 20)
+    checkpoint = os.path.join(outputdir, 'prefetch_checkpoint.txt')
+    failed = prefetch(list(dfplan['ticker']), fetch, workers=workers, requests=requests, window=window,
+                      retries=retries, checkpoint=checkpoint, verbose=verbose)
+
+    if len(failed) > 0:
+        load_etf_data_logs.error("Failed to load " + str(len(failed)) + " tickers: " + " ".join(failed))
+
+    # check the files instead of stock.df_yahoo, which is not reliable
+    stale = planrefresh(dfplan['ticker'], outputdir)
+    if verbose and len(stale) > 0:
+        load_etf_data_logs.info(str(len(stale)) + " tickers got no new data (market holiday or no data at the source)")
+
+    return failed
 
 
 def main():
 
     args = getargs()
     tickerlist = etflist(verbose=args.verbose)
-    getetfdata(tickerlist, fetchincompletedata=args.fetchincompletedata, verbose=args.verbose)
+    getetfdata(tickerlist, fetchincompletedata=args.fetchincompletedata, verbose=args.verbose, workers=args.workers,
+               requests=args.requests, window=args.window, retries=args.retries, dryrun=args.dryrun)
 
 
 if __name__ == '__main__':
@@ -7,6 +7,8 @@ import glob
 
 from stockanalysis import helpers
 
+import historylog
+
 import datetime as dt
 import getpass
 import os
@@ -337,18 +339,18 @@ class Mykplan:
         if verbose:
             print("Reading current portfolio value from this page")
 
+        todaydate_str = dt.date.strftime(dt.date.today(), "%m/%d/%Y")
+
+        # the portfolio value log [Date, PortfolioValue401k] is append-only, so only its last row has to be checked
+        # to make sure today's value is not already added (which happens if the code runs multiple times in a day)
+        lastrow = None
         if os.path.exists(self.portfoliovalue):
-            df_portfoliovalue = pd.read_csv(self.portfoliovalue)
-        else:
-            df_portfoliovalue = pd.DataFrame(columns=['Date', 'PortfolioValue401k'])
+            historylog.repairtail(self.portfoliovalue)
+            lastrow = historylog.lastrow(self.portfoliovalue)
 
-        todaydate_str = dt.date.strftime(dt.date.today(), "%m/%d/%Y")
-        # add a new row of portfolio value but make sure it is not already added
-        # (which happens if the code runs multiple times in a single day)
-        if df_portfoliovalue[(df_portfoliovalue['Date'] == todaydate_str)].empty:
-            df_portfoliovalue = df_portfoliovalue.append({'Date': todaydate_str, 'PortfolioValue401k': portfoliovalue},
-                                                         ignore_index=True)
-            df_portfoliovalue.to_csv(self.portfoliovalue, index=False)
+        if lastrow is None or lastrow['Date'] != todaydate_str:
+            historylog.appendlines(self.portfoliovalue, [todaydate_str + ',' + repr(portfoliovalue)],
+                                   header='Date,PortfolioValue401k')
 
             if verbose:
                 print("Saving current portfoliovalue to CSV file: ", self.portfoliovalue)
@@ -421,32 +423,19 @@ class Mykplan:
         dfwfundnames = self.mergefundnames(df)
 
         # ------------ PORTFOLIO ALLOCATION ------------
-        # set these dataframes to empty in case the files do not exist
-        df_portfolio_allocation = pd.DataFrame()
-
-        # import portfolio allocation file which contains historical portfolio allocation data
-        if os.path.exists(self.portfolio_allocation_history):
-            df_portfolio_allocation = pd.read_csv(self.portfolio_allocation_history)
-
-        # historical data will be added as a new column with today's date as the column header
-        today_str = dt.date.strftime(dt.date.today(), "%d-%b-%Y")
-
         if verbose:
             print("Reading portfolio allocation from this page")
 
-        # merging on the ticker will map the current portfolio allocation to the correct ticker symbols
-        try:
-            df_portfolio_allocation = df_portfolio_allocation.merge(
-                dfwfundnames[['ticker', '% of Assets']].rename(columns={'% of Assets': today_str}),
-                on='ticker', how='outer', suffixes=(False, False)).fillna(0)
-            df_portfolio_allocation.to_csv(self.portfolio_allocation_history, index=False)
+        # historical data is appended to a long-format log [Date, ticker, value] with today's date
+        # On the '% of Assets' column, strip off everything (%) except numbers and "."
+        allocation = pd.Series(list(map(currencytofloat, dfwfundnames['% of Assets'].astype(str))),
+                               index=dfwfundnames['ticker'])
+        allocationlog = historylog.longstore(self.portfolio_allocation_history)
 
+        if historylog.upserthistory(allocationlog, allocation, widefile=self.portfolio_allocation_history):
             if verbose:
-                print("Writing historical portfolio allocation data to file:", self.portfolio_allocation_history)
-
-        # if the code is run multiple times in a single day the merge will fail with ValueError exception
-        # since pandas was forced to abandon its attempt to rename identical columns with suffixes _x, _y
-        except ValueError:
+                print("Writing historical portfolio allocation data to file:", allocationlog)
+        else:
             if verbose:
                 print("Historical ticker portfolio allocation data already written to file today. "
                       "Multiple runs will not add any more data to file.")
@@ -466,26 +455,15 @@ class Mykplan:
         dfwfundnames = self.mergefundnames(df)
 
         # ------------ FUND PRICE ------------
-        # import portfolio allocation file which contains historical prices for the funds that were in the portfolio
-        if os.path.exists(self.fund_prices_history):
-            df_fund_price = pd.read_csv(self.fund_prices_history)
-
-        # historical data will be added as a new column with today's date as the column header
-        today_str = dt.date.strftime(dt.date.today(), "%d-%b-%Y")
-
-        # merging on the ticker will map the current prices to the correct ticker symbols
-        try:
-            df_fund_price = df_fund_price.merge(dfwfundnames[['ticker', 'Price']].
-                                                rename(columns={'Price': today_str}),
-                                                on='ticker', how='outer', suffixes=(False, False)).fillna(0)
-            df_fund_price.to_csv(self.fund_prices_history, index=False)
+        # historical prices of the funds in the portfolio are appended to a long-format log [Date, ticker, value]
+        # with today's date
+        prices = dfwfundnames.set_index('ticker')['Price']
+        pricelog = historylog.longstore(self.fund_prices_history)
 
+        if historylog.upserthistory(pricelog, prices, widefile=self.fund_prices_history):
             if verbose:
-                print("Writing historical ticker price data to file:", self.fund_prices_history)
-
-        # if the code is run multiple times in a single day the merge will fail with ValueError exception since pandas
-        # was forced to abandon its attempt to rename identical columns with suffixes _x, _y
-        except ValueError:
+                print("Writing historical ticker price data to file:", pricelog)
+        else:
             if verbose:
                 print("Historical ticker price data already written to file today. "
                       "Multiple runs will not add amy more data to file.")
@@ -0,0 +1,200 @@
+# this is a module file
+# to cache the close prices loaded by GetStockData. This file is not executable
+from stockanalysis import helpers
+from stockanalysis import getstockdata as gd
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+
+pricecachelogs = logging.getLogger('pricecache')
+
+# size bounds of the in-process cache (number of tickers) and of the on-disk cache (bytes)
+MAXENTRIES = 256
+MAXDISKBYTES = 256 * 1024 * 1024
+
+# in-process LRU cache {ticker: {'startdate', 'enddate', 'signature', 'close'}}
+memorycache = OrderedDict()
+# getclose() may be called from several threads
+cachelock = threading.Lock()
+
+# directories read from the settings file on first use
+dirs = {}
+# listings of the stockdata directories {path: (mtime, {prefix: [file names]})}
+stockdirs = {}
+# size in bytes of the on-disk caches {cachedir: bytes}
+diskbytes = {}
+
+
+def getdirs():
+    """Returns the stockdata directory and the on-disk cache directory"""
+
+    if len(dirs) == 0:
+        settings = helpers.load_settings_stocks()
+        dirs['stockdata'] = settings['stockdata']
+        dirs['pricecache'] = os.path.join(settings['output_dir'], 'pricecache')
+        os.makedirs(dirs['pricecache'], exist_ok=True)
+
+    return dirs['stockdata'], dirs['pricecache']
+
+
+def stockfilenames(path):
+    """
+    {prefix: [file names]} of the stockdata directory, every file listed under each of its names up to a '.', so
+    that the files of a ticker are stockfilenames(path)[ticker] like glob(ticker + '.*').
+    The directory is only listed again when its mtime changes, i.e. when files are added, removed or renamed
+    """
+
+    mtime = os.stat(path).st_mtime_ns
+    with cachelock:
+        listing = stockdirs.get(path)
+    if listing is not None and listing[0] == mtime:
+        return listing[1]
+
+    names = {}
+    for name in sorted(os.listdir(path)):
+        if name.startswith('.'):
+            continue
+        dot = name.find('.')
+        while dot >= 0:
+            names.setdefault(name[:dot], []).append(name)
+            dot = name.find('.', dot + 1)
+
+    with cachelock:
+        stockdirs[path] = (mtime, names)
+    return names
+
+
+def stockfilesignature(ticker, path):
+    """(name, size, mtime) of the stockdata files of a ticker. A cached panel is stale when the signature changes"""
+
+    signature = []
+    for name in stockfilenames(path).get(ticker, []):
+        try:
+            st = os.stat(os.path.join(path, name))
+        except FileNotFoundError:
+            continue
+        signature.append((name, st.st_size, st.st_mtime_ns))
+    return tuple(signature)
+
+
+def readdiskcache(cachefile):
+    try:
+        entry = pd.read_pickle(cachefile)
+        # mark as recently used for eviction
+        os.utime(cachefile)
+        return entry
+    except (OSError, EOFError, ValueError, KeyError):
+        return None
+
+
+def writediskcache(cachefile, entry):
+    cachedir = os.path.dirname(cachefile)
+    oldsize = os.path.getsize(cachefile) if os.path.exists(cachefile) else 0
+    pd.to_pickle(entry, cachefile + '.tmp')
+    os.replace(cachefile + '.tmp', cachefile)
+    newsize = os.path.getsize(cachefile)
+
+    with cachelock:
+        # the size of the cache is listed once and then kept up to date, the directory is only listed again to evict
+        if cachedir not in diskbytes:
+            diskbytes[cachedir] = sum(os.path.getsize(os.path.join(cachedir, f)) for f in os.listdir(cachedir)
+                                      if f.endswith('.pkl'))
+        else:
+            diskbytes[cachedir] += newsize - oldsize
+        if diskbytes[cachedir] <= MAXDISKBYTES:
+            return
+
+        # evict the least recently used files once the cache is over its size limit
+        files = [os.path.join(cachedir, f) for f in os.listdir(cachedir) if f.endswith('.pkl')]
+        files = sorted(files, key=lambda f: os.stat(f).st_mtime_ns)
+        totalsize = sum(os.path.getsize(f) for f in files)
+        for f in files:
+            if totalsize <= MAXDISKBYTES or f == cachefile:
+                break
+            totalsize -= os.path.getsize(f)
+            os.remove(f)
+        diskbytes[cachedir] = totalsize
+
+
+def iscomplete(entry, enddate):
+    """
+    True when a cache entry needs no download to serve enddate: it was loaded with fetchincompletedata up to
+    enddate, or its prices already reach the last business day before enddate
+    """
+
+    fetchedend = entry.get('fetchedend')
+    if fetchedend is not None and fetchedend >= enddate:
+        return True
+    close = entry['close']
+    return len(close) > 0 and close.index[-1] >= enddate.normalize() - pd.offsets.BDay(1)
+
+
+def getclose(ticker, startdate, enddate, path=None, fetchincompletedata=True, verbose=False):
+    """
+    Returns the Close prices of a ticker between startdate and enddate as a Series indexed by Date.
+    Reads through an in-process LRU cache and an on-disk cache. Each cache entry holds the widest date range loaded
+    so far for a ticker, so nearly identical windows are served from the same entry. Entries are reloaded when the
+    ticker's file in the stockdata directory changes. With fetchincompletedata an entry whose prices stop before
+    enddate is only used if it was itself loaded with fetchincompletedata, otherwise GetStockData is asked again
+    :param ticker:
+    :param startdate:
+    :param enddate:
+    :param path: stockdata directory [Default=stockdata from the settings file]
+    :param fetchincompletedata:
+    :param verbose:
+    :return: close
+    """
+
+    stockdata, cachedir = getdirs()
+    if path is None:
+        path = stockdata
+
+    startdate = pd.Timestamp(startdate)
+    enddate = pd.Timestamp(enddate)
+    cachefile = os.path.join(cachedir, ticker + '.pkl')
+    signature = stockfilesignature(ticker, path)
+
+    entry = memorycache.get(ticker)
+    if entry is None or entry['signature'] != signature:
+        entry = readdiskcache(cachefile)
+
+    if entry is not None and entry['signature'] == signature:
+        if entry['startdate'] <= startdate and entry['enddate'] >= enddate and \
+                (not fetchincompletedata or iscomplete(entry, enddate)):
+            with cachelock:
+                memorycache[ticker] = entry
+                memorycache.move_to_end(ticker)
+            return entry['close'].loc[startdate:enddate]
+        # widen the cached range so both windows are served by one entry
+        loadstart = min(startdate, entry['startdate'])
+        loadend = max(enddate, entry['enddate'])
+    else:
+        loadstart = startdate
+        loadend = enddate
+
+    if verbose:
+        pricecachelogs.info("Loading " + ticker + " prices from " + str(loadstart.date()) + " to " +
+                            str(loadend.date()))
+
+    stock = gd.GetStockData(ticker=ticker, path=path, fetchincompletedata=fetchincompletedata, verbose=verbose)
+    close = stock.getdata(loadstart, loadend)['Close']
+    close.index = pd.DatetimeIndex(close.index, name='Date')
+    close = close[~close.index.duplicated()].sort_index()
+
+    # GetStockData may have written new data to the stockdata file
+    entry = {'startdate': loadstart, 'enddate': loadend, 'signature': stockfilesignature(ticker, path),
+             'close': close, 'fetchedend': loadend if fetchincompletedata else None}
+    writediskcache(cachefile, entry)
+
+    with cachelock:
+        memorycache[ticker] = entry
+        memorycache.move_to_end(ticker)
+        while len(memorycache) > MAXENTRIES:
+            memorycache.popitem(last=False)
+
+    return close.loc[startdate:enddate]
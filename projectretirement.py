@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+from stockanalysis import helpers
+
+import argparse
+import datetime as dt
+import logging
+import os
+
+import fundperformance
+import retirementportfolio as rt
+import pandas as pd
+import numpy as np
+import matplotlib.pyplot as plt
+
+
+projectionlogs = logging.getLogger("projectretirement")
+
+PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def r(n):
+    return np.round(n, 2)
+
+
+def getargs():
+    # parse command-line arguments using argparse()
+    description = "Project the portfolio value at retirement with Monte Carlo simulations of the fund returns."
+    epilog = "./projectretirement.py -y 25 -n 20000 -s 42"
+    parser = argparse.ArgumentParser(description=description, epilog=epilog)
+    parser.add_argument('-v', '--verbose', help='Verbose mode [Default=Off]', action='store_true')
+    parser.add_argument('-y', '--years', help='Years to retirement [Default=25]', type=int, default=25)
+    parser.add_argument('-n', '--paths', help='Number of simulated paths [Default=20000]', type=int, default=20000)
+    parser.add_argument('-s', '--seed', help='Seed of the random number generator [Default=42]', type=int,
+                        default=42)
+    parser.add_argument('-m', '--method', help='bootstrap: resample blocks of historical monthly returns, '
+                                               'normal: draw from a normal distribution with the historical mean and '
+                                               'variance [Default=bootstrap]',
+                        type=str, default='bootstrap', choices=['bootstrap', 'normal'])
+    parser.add_argument('-b', '--block', help='Length in months of the resampled blocks [Default=12]', type=int,
+                        default=12)
+    parser.add_argument('-H', '--history', help='Years of fund prices to learn the returns from [Default=20]',
+                        type=int, default=20)
+    parser.add_argument('-c', '--contrib', help='Annual contribution, capped by the annual limit '
+                                                '[Default=the annual limit]', type=float)
+    parser.add_argument('-g', '--limitgrowth', help='Yearly increase of the contribution limit [Default=500]',
+                        type=float, default=500)
+    parser.add_argument('--noplot', help='Do not plot [Default=Off]', action='store_true')
+    args = parser.parse_args()
+    return args
+
+
+def monthlyreturns(funds, weights, years=20):
+    """
+    Historical monthly returns of a fixed-weight portfolio rebalanced every month. Only months in which every fund
+    with a weight has a price are kept
+    :param funds: fund tickers
+    :param weights: weights of the funds, adding up to 1
+    :param years: years of price history
+    :return: monthly returns as a numpy array
+    """
+
+    enddate = dt.datetime.today()
+    startdate = enddate - dt.timedelta(days=years * 365)
+    funds = [tickr for tickr, w in zip(funds, weights) if w > 0]
+    weights = np.array([w for w in weights if w > 0], dtype=float)
+
+    df = fundperformance.loadpanel(funds, startdate, enddate)
+    # last price of every month
+    df = df.groupby(df.index.to_period('M')).last()
+    rets = (df / df.shift(1) - 1).to_numpy()[1:]
+    rets = rets[~np.isnan(rets).any(axis=1)]
+
+    if len(rets) < 12:
+        raise ValueError("Need at least 12 months of prices of all funds, found " + str(len(rets)))
+
+    return rets @ weights
+
+
+def contributionschedule(months, annualcontrib, maxcontrib, allowedcontrib, limitgrowth=500, today=None):
+    """
+    Contribution of every future month. The annual contribution is spread evenly over the months of a year and capped
+    by the limit of the year, which grows by limitgrowth a year. This year only the allowance left is contributed
+    :param months: months to simulate, starting next month
+    :param annualcontrib:
+    :param maxcontrib: contribution limit of this year
+    :param allowedcontrib: contribution allowance left this year
+    :param limitgrowth:
+    :param today:
+    :return: contributions as a numpy array
+    """
+
+    if today is None:
+        today = dt.date.today()
+
+    # calendar year offset of every simulated month, simulated months start next month
+    monthofyear = today.month + np.arange(months)
+    yearoffset = monthofyear // 12
+    limit = maxcontrib + limitgrowth * yearoffset
+    contrib = np.minimum(annualcontrib, limit) / 12
+
+    # the rest of this year: the allowance left over the months left
+    thisyear = yearoffset == 0
+    if thisyear.any():
+        contrib[thisyear] = max(min(annualcontrib / 12 * thisyear.sum(), allowedcontrib), 0) / thisyear.sum()
+
+    return contrib
+
+
+def projectpaths(currentvalue, rets, contrib, paths=20000, seed=42, method='bootstrap', block=12):
+    """
+    Simulates the portfolio value at the end of every month of many paths at once. Every month the contribution is
+    added and the portfolio earns the return of the month: V[t] = (V[t-1] + c[t]) * (1 + R[t]).
+    With G[t] the growth of 1 dollar up to month t, V[t] = G[t] * (V[0] + sum(c[s] / G[s-1], s <= t)), so all paths
+    are evaluated with cumulative products and sums
+    :param currentvalue: value of the portfolio today
+    :param rets: historical monthly returns of the portfolio
+    :param contrib: contribution of every simulated month
+    :param paths:
+    :param seed:
+    :param method: bootstrap or normal
+    :param block: length of the resampled blocks of consecutive months
+    :return: values in the format paths x months
+    """
+
+    rng = np.random.default_rng(seed)
+    months = len(contrib)
+
+    if method == 'bootstrap':
+        # blocks of consecutive months keep the autocorrelation of the returns, wrapping around the end
+        nblocks = -(-months // block)
+        starts = rng.integers(0, len(rets), size=(paths, nblocks, 1))
+        idx = ((starts + np.arange(block)) % len(rets)).reshape(paths, nblocks * block)[:, :months]
+        simrets = rets[idx]
+    elif method == 'normal':
+        simrets = rng.normal(rets.mean(), rets.std(ddof=1), size=(paths, months))
+    else:
+        raise ValueError("Unknown method " + str(method))
+
+    growth = np.cumprod(1 + simrets, axis=1)
+    prevgrowth = np.hstack([np.ones((paths, 1)), growth[:, :-1]])
+
+    return growth * (currentvalue + np.cumsum(contrib / prevgrowth, axis=1))
+
+
+def percentilebands(values, percentiles=PERCENTILES, today=None):
+    """
+    Percentiles of the simulated values at the end of every year
+    :param values: paths x months
+    :param percentiles:
+    :param today:
+    :return: df in the format [year, p<percentile>, ...]
+    """
+
+    if today is None:
+        today = dt.date.today()
+
+    # simulated months start next month, month 11 is December
+    monthofyear = today.month + np.arange(values.shape[1])
+    yearend = np.flatnonzero(monthofyear % 12 == 11)
+    if len(yearend) == 0 or yearend[-1] != values.shape[1] - 1:
+        yearend = np.append(yearend, values.shape[1] - 1)
+
+    bands = np.percentile(values[:, yearend], percentiles, axis=0).T
+    df = pd.DataFrame(r(bands), columns=['p' + str(p) for p in percentiles])
+    df.insert(0, 'year', today.year + monthofyear[yearend] // 12)
+
+    return df
+
+
+def projectretirement(portfolio, funds, weights, years=25, paths=20000, seed=42, method='bootstrap', block=12,
+                      history=20, annualcontrib=None, limitgrowth=500, verbose=False):
+    """
+    Projects the value of the portfolio to retirement starting from the current value and contribution allowance of
+    Retirementportfolio.summary()
+    :param portfolio: Retirementportfolio
+    :param funds:
+    :param weights: allocation of the contributions, adding up to 1
+    :param years: years to retirement
+    :param paths:
+    :param seed:
+    :param method:
+    :param block:
+    :param history: years of price history
+    :param annualcontrib: [Default=the contribution limit]
+    :param limitgrowth:
+    :param verbose:
+    :return: dfbands in the format [year, p5, p25, p50, p75, p95]
+    """
+
+    summary = portfolio.summary()
+    currentvalue = float(summary["Current portfolio value"])
+    maxcontrib = float(summary["Max Contribution for this year"])
+    allowedcontrib = float(summary["Allowed Contribution left"])
+    if annualcontrib is None:
+        annualcontrib = maxcontrib
+
+    rets = monthlyreturns(funds, weights, history)
+    if verbose:
+        projectionlogs.info("Simulating {0} paths of {1} months from {2} months of returns".format(
+            paths, years * 12, len(rets)))
+    contrib = contributionschedule(years * 12, annualcontrib, maxcontrib, allowedcontrib, limitgrowth)
+    values = projectpaths(currentvalue, rets, contrib, paths, seed, method, block)
+
+    return percentilebands(values)
+
+
+def main():
+    args = getargs()
+    verbose = args.verbose
+
+    # load configurations from settings file
+    settings = helpers.load_settings_stocks()
+    inputdir = settings['input_dir']
+    outputdir = settings['output_dir']
+
+    # import available mutual funds and their percentage allocation in the portfolio.
+    # format: [fund_name, funds, allocation]
+    mfnames = inputdir + 'mutual-funds-available-in-mykplan.csv'
+    if verbose:
+        print('Loading ' + mfnames)
+    allocs = pd.read_csv(mfnames)
+    weights = allocs['allocation'].to_numpy(dtype='float') / 100
+
+    portfolio = rt.Retirementportfolio(importquicken=True, verbose=verbose)
+
+    dfbands = projectretirement(portfolio, list(allocs['funds']), weights, years=args.years, paths=args.paths,
+                                seed=args.seed, method=args.method, block=args.block, history=args.history,
+                                annualcontrib=args.contrib, limitgrowth=args.limitgrowth,
+                                verbose=verbose)
+
+    print(dfbands.to_string(index=False))
+    dfbands.to_csv(os.path.join(outputdir, 'retirement_projection.csv'), index=False)
+
+    if not args.noplot:
+        dfbands = dfbands.set_index('year')
+        plt.fill_between(dfbands.index, dfbands['p5'], dfbands['p95'], alpha=0.2, label='5-95%')
+        plt.fill_between(dfbands.index, dfbands['p25'], dfbands['p75'], alpha=0.4, label='25-75%')
+        plt.plot(dfbands.index, dfbands['p50'], label='median')
+        plt.legend()
+        plt.show()
+
+
+if __name__ == '__main__':
+    helpers.initiate_logging()
+    main()
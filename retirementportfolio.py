@@ -1,17 +1,31 @@
 # this is a class file
 # to analyse 401k portfolio. This file is not executable
 from stockanalysis import helpers
-from stockanalysis import getstockdata as gd
 
 import datetime as dt
+import decimal
+import hashlib
+import html
 import logging
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from glob import glob
 
 import numpy as np
 import pandas as pd
 from ofxparse import OfxParser
+from tqdm import tqdm
+
+import historylog
+import pricecache
+
+# pyarrow is optional. Without it the 401kexport CSV is used as the transaction store
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
 
 
 rflogs = logging.getLogger('retirementportfolio')
@@ -21,6 +35,432 @@ def r(num):
     return np.round(num, 2)
 
 
+def filehash(filename, blocksize=1 << 20):
+    """Returns the sha256 hex digest of a file, read in blocks so large QFX files are not loaded at once"""
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def normalisetransactions(df):
+    """
+    Brings freshly parsed transactions and transactions read back from the 401kexport CSV to the same dtypes so
+    drop_duplicates() can match them
+    :param df:
+    :return: df
+    """
+
+    df = df.copy()
+    df['Date'] = pd.to_datetime(df['Date'])
+    for col in ['units', 'unit_price', 'price']:
+        df[col] = df[col].astype('float')
+    # empty strings from ofxparse are read back from CSV as NaN
+    for col in ['security', 'ticker', 'name', 'income_type', 'memo']:
+        df[col] = df[col].astype('object').where(df[col].notna() & (df[col] != ''), np.nan)
+
+    return df
+
+
+def readtransactions(csvfile):
+    """Reads the merged transactions exported by importquicken()"""
+    df = pd.read_csv(csvfile, header=0, dtype={'security': str, 'ticker': str, 'income_type': str})
+    return normalisetransactions(df)
+
+
+def typetransactions(df):
+    """
+    Casts normalised transactions to the schema of the columnar store: datetime64 Date, float units and prices,
+    categorical memo, ticker and name
+    :param df:
+    :return: df
+    """
+
+    df = df.reset_index(drop=True)
+    for col in ['memo', 'ticker', 'name']:
+        df[col] = df[col].astype('category')
+
+    return df
+
+
+def transactionstore(csvfile):
+    """Path of the columnar (Feather) transaction store kept next to the 401kexport CSV"""
+    return os.path.splitext(csvfile)[0] + '.feather'
+
+
+def loadtransactions(csvfile):
+    """
+    Loads the merged transactions from the columnar store, falling back to the 401kexport CSV.
+    The store is memory-mapped and converted one column per block, so the Date, category code and number columns
+    without missing values are read-only views of the mapped file. Strings and columns with missing values are copied
+    :param csvfile:
+    :return: df
+    """
+
+    storefile = transactionstore(csvfile)
+    if feather is not None and os.path.exists(storefile):
+        return feather.read_table(storefile, memory_map=True).to_pandas(split_blocks=True, self_destruct=True)
+
+    return typetransactions(readtransactions(csvfile))
+
+
+def savetransactions(df, csvfile, exporttocsv=True):
+    """
+    Writes the merged transactions to the columnar store. The CSV file is only an export format and is written when
+    exporttocsv=True or when pyarrow is not installed
+    """
+
+    if feather is not None:
+        storefile = transactionstore(csvfile)
+        # uncompressed so that the file can be memory-mapped on load. write and rename so a crash leaves the old store
+        feather.write_feather(df, storefile + '.tmp', compression='uncompressed')
+        os.replace(storefile + '.tmp', storefile)
+
+    if exporttocsv or feather is None:
+        df.to_csv(csvfile, index=False)
+
+
+# OFX aggregates that OfxParser reads as investment transactions
+QFXTRANSACTIONS = {'BUYDEBT', 'BUYMF', 'BUYOPT', 'BUYOTHER', 'BUYSTOCK', 'CLOSUREOPT', 'INCOME', 'INVEXPENSE',
+                   'JRNLFUND', 'JRNLSEC', 'MARGININTEREST', 'REINVEST', 'RETOFCAP', 'SELLDEBT', 'SELLMF', 'SELLOPT',
+                   'SELLOTHER', 'SELLSTOCK', 'SPLIT', 'TRANSFER'}
+
+
+def iterqfxtags(qfx_file, blocksize=1 << 16):
+    """
+    Streams the (TAG, value) pairs of a quicken file. Closing tags are returned as ('/TAG', '').
+    Works for SGML (OFX 1.x, leaf elements without closing tags) and XML (OFX 2.x) files alike
+    """
+
+    def splittoken(token):
+        tag, _, value = token.partition('>')
+        return tag.strip().upper(), html.unescape(value.strip())
+
+    with open(qfx_file, "r", encoding="utf-8") as f:
+        buffer = ''
+        for block in iter(lambda: f.read(blocksize), ''):
+            tokens = (buffer + block).split('<')
+            # the last token may continue in the next block
+            buffer = tokens.pop()
+            for token in tokens:
+                # skip the OFX header and the <?xml ?> / <!-- --> declarations
+                if '>' in token and token[0] not in '?!':
+                    yield splittoken(token)
+        if '>' in buffer and buffer[0] not in '?!':
+            yield splittoken(buffer)
+
+
+def parseqfxdate(qfxdate):
+    """Parses an OFX date like 20101106160000.000[-5:EST] the same way OfxParser does"""
+
+    res = re.search(r"\[(?P<tz>[-+]?\d+\.?\d*):\w*\]$", qfxdate)
+    tzoffset = dt.timedelta(hours=float(res.group('tz'))) if res else dt.timedelta(0)
+    res = re.search(r"^[0-9]*\.([0-9]{0,5})", qfxdate)
+    msec = dt.timedelta(seconds=float("0." + res.group(1))) if res else dt.timedelta(0)
+
+    try:
+        localdate = dt.datetime.strptime(qfxdate[:14], '%Y%m%d%H%M%S')
+    except ValueError:
+        if qfxdate[:8] == "00000000":
+            return None
+        localdate = dt.datetime.strptime(qfxdate[:8], '%Y%m%d')
+
+    return localdate - tzoffset + msec
+
+
+def qfxdecimal(value):
+    """Converts an OFX amount to Decimal, accepting 10,000.50, 10.000,50 and 10000,50 formats like OfxParser"""
+
+    if re.search(r'.*\..*,', value):
+        value = value.replace('.', '')
+    if re.search(r'.*,.*\.', value):
+        value = value.replace(',', '')
+    if '.' not in value and ',' in value:
+        value = value.replace(',', '.')
+
+    return decimal.Decimal(value.replace(' ', ''))
+
+
+def readqfxsecurities(qfx_file):
+    """Streams the security list of a quicken file into a dict {uniqueid: (ticker, name)}"""
+
+    securities = {}
+    secinfo = None
+    for tag, value in iterqfxtags(qfx_file):
+        if tag == 'SECINFO':
+            secinfo = {}
+        elif tag == '/SECINFO':
+            securities[secinfo.get('UNIQUEID')] = (secinfo.get('TICKER') or None, secinfo.get('SECNAME'))
+            secinfo = None
+        elif secinfo is not None and value:
+            secinfo.setdefault(tag, value)
+
+    return securities
+
+
+def qfxframe(rows):
+    """Builds a chunk of streamed transactions in the format of exporttransactions()"""
+
+    df_transactions = pd.DataFrame(rows, columns=['Date', 'security', 'ticker', 'name', 'income_type', 'memo',
+                                                  'units', 'unit_price'])
+    df_transactions['price'] = df_transactions['units'] * df_transactions['unit_price']
+
+    return df_transactions.sort_values(by=['Date'], kind='stable')
+
+
+def iterqfx(qfx_file, chunksize=10000):
+    """
+    Streams the transactions of a quicken file in chunks of at most chunksize rows, in the format of
+    exporttransactions(), without building the OFX object tree in memory.
+    The file is read twice: the security list comes after the transactions in a statement
+    :param qfx_file:
+    :param chunksize:
+    :return: generator of dataframes
+    """
+
+    securities = readqfxsecurities(qfx_file)
+
+    rows = []
+    chunks = 0
+    aggregate = None
+    transaction = None
+    for tag, value in iterqfxtags(qfx_file):
+        if transaction is None:
+            if tag in QFXTRANSACTIONS:
+                aggregate = '/' + tag
+                transaction = {}
+            continue
+
+        if tag != aggregate:
+            # the first occurrence of a tag wins, like OfxParser's find()
+            if value:
+                transaction.setdefault(tag, value)
+            continue
+
+        # transactions of securities missing from the security list are dropped, like exporttransactions()
+        security = transaction.get('UNIQUEID', '')
+        if security in securities:
+            settledate = transaction.get('DTSETTLE')
+            rows.append([parseqfxdate(settledate) if settledate else None, security, securities[security][0],
+                         securities[security][1], transaction.get('INCOMETYPE', ''), transaction.get('MEMO', ''),
+                         qfxdecimal(transaction.get('UNITS', '0')), qfxdecimal(transaction.get('UNITPRICE', '0'))])
+        transaction = None
+
+        if len(rows) >= chunksize:
+            yield qfxframe(rows)
+            chunks += 1
+            rows = []
+
+    if len(rows) > 0 or chunks == 0:
+        yield qfxframe(rows)
+
+
+def parseqfx(qfx_file, streaming=False):
+    """
+    Parses a single quicken file into the transaction format of exporttransactions(). Runs in worker processes
+    streaming=True reads the file chunk by chunk with iterqfx() instead of OfxParser
+    """
+
+    if streaming:
+        return pd.concat([normalisetransactions(df) for df in iterqfx(qfx_file)])
+
+    with open(qfx_file, "r", encoding="utf-8") as f:
+        qfx = OfxParser.parse(f)
+    return normalisetransactions(Retirementportfolio.exporttransactions(qfx))
+
+
+# small tables read once per process and re-read only when the file changes {filename: (mtime_ns, value)}
+filecache = {}
+
+
+def readcached(filename, reader):
+    """Returns reader(filename), calling reader again only when the mtime of the file changes"""
+
+    mtime = os.stat(filename).st_mtime_ns
+    cached = filecache.get(filename)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, reader(filename))
+        filecache[filename] = cached
+
+    return cached[1]
+
+
+def contributions(df):
+    """Contributions per day in the format ['Date', 'contrib'] from a transaction table"""
+
+    contrib = df['memo'] == 'Contribution'
+    dfcontrib = pd.DataFrame({'Date': pd.to_datetime(df.loc[contrib, 'Date']).dt.normalize(),
+                              'contrib': df.loc[contrib, 'price'].astype('float')})
+
+    return dfcontrib.groupby('Date').sum().reset_index()
+
+
+def dividends(df):
+    """Dividend distributions in the format ['Date', 'name', 'dividend'] from a transaction table"""
+
+    dfdividends = df[(df['memo'] == 'Dividends and Earnings') & (df['price'] > 5)][['Date', 'name', 'price']]
+    dfdividends = dfdividends.rename(columns={'price': 'dividend'})
+    dfdividends['Date'] = pd.to_datetime(dfdividends['Date']).dt.normalize()
+
+    return dfdividends
+
+
+def readonlytable(df):
+    """
+    Rebuilds a table on read-only copies of its columns, so that shallow copies of it can be handed out without
+    callers changing it. Under copy-on-write (pandas 3) pandas already protects shared data and the table is kept
+    as it is. Otherwise the table can only be shared when every column is a numpy array that pandas keeps read-only,
+    extension columns (e.g. categoricals) and versions that consolidate the columns into new writeable blocks are not
+    :param df:
+    :return: (df, shared)
+    """
+
+    try:
+        copyonwrite = int(pd.__version__.split('.')[0]) >= 3 or pd.get_option('mode.copy_on_write') is True
+    except KeyError:
+        copyonwrite = False
+    if copyonwrite:
+        return df, True
+
+    if not all(isinstance(dtype, np.dtype) for dtype in df.dtypes):
+        return df, False
+
+    columns = {}
+    for col in df.columns:
+        values = df[col].to_numpy(copy=True)
+        values.flags.writeable = False
+        columns[col] = values
+    dfreadonly = pd.DataFrame(columns, index=df.index, columns=df.columns, copy=False)
+
+    return dfreadonly, not any(dfreadonly[col].to_numpy().flags.writeable for col in dfreadonly.columns)
+
+
+# columns of the holdings ledger saved by Retirementportfolio.ledger()
+LEDGERCOLUMNS = ['ticker', 'name', 'units', 'costbasis', 'realizedgain', 'dividends', 'lastprice', 'transactions',
+                 'lastdate']
+
+
+def costbasis(df, units0=None, cost0=None):
+    """
+    Average-cost ledger of transactions sorted by date. Buys (units > 0) add their amount to the cost of the fund,
+    sells take out the average cost of the units sold: cost[k] = cost[k-1] * f[k] + buy[k] with f[k] = units[k] /
+    units[k-1] for sells and 1 for buys. Solved for all funds in one grouped pass as
+    cost[k] = F[k] * cumsum(buy / F)[k] with F = cumprod(f), restarting after every full liquidation
+    :param df: transactions with the columns ['ticker', 'units', 'unit_price']
+    :param units0: units held before the first transaction, indexed by ticker
+    :param cost0: cost of the units held before the first transaction, indexed by ticker
+    :return: df with the columns ['units', 'cost', 'realized'] after every transaction
+    """
+
+    tickers = df['ticker'].astype(str).to_numpy()
+    units = df['units'].to_numpy(dtype=float)
+    unitprice = df['unit_price'].to_numpy(dtype=float)
+
+    if units0 is not None:
+        # the position carried over from an earlier run is a buy in front of the new transactions
+        units0 = units0[units0 != 0]
+        tickers = np.concatenate([units0.index.to_numpy(dtype=str), tickers])
+        units = np.concatenate([units0.to_numpy(dtype=float), units])
+        unitprice = np.concatenate([cost0.reindex(units0.index).to_numpy(dtype=float) / units0.to_numpy(dtype=float),
+                                    unitprice])
+    seeds = len(tickers) - len(df)
+
+    # stable sort by ticker keeps the date order inside every fund
+    order = np.argsort(tickers, kind='stable')
+    tickers, units, unitprice = tickers[order], units[order], unitprice[order]
+    key = pd.Series(tickers)
+
+    held = pd.Series(units).groupby(key).cumsum().to_numpy()
+    held = np.where(np.abs(held) < 1e-6, 0.0, held)
+    previous = held - units
+    closed = held == 0
+
+    # segments of a fund restart after a full liquidation
+    segment = pd.Series(closed).groupby(key).shift(fill_value=False).groupby(key).cumsum().to_numpy()
+    group = [key, pd.Series(segment)]
+
+    buy = np.where(units > 0, units * unitprice, 0.0)
+    f = np.where((units < 0) & (previous > 0), held / np.where(previous > 0, previous, 1), 1.0)
+    growth = pd.Series(f).groupby(group).cumprod().to_numpy()
+    safegrowth = np.where(growth > 0, growth, 1.0)
+    cost = np.where(closed, 0.0, growth * pd.Series(buy / safegrowth).groupby(group).cumsum().to_numpy())
+
+    # realized gain of a sell: proceeds less the average cost of the units sold
+    previouscost = pd.Series(cost).groupby(key).shift(fill_value=0.0).to_numpy()
+    avgcost = previouscost / np.where(previous > 0, previous, np.nan)
+    realized = np.where(units < 0, -units * (unitprice - np.nan_to_num(avgcost)), 0.0)
+
+    dfledger = pd.DataFrame({'ticker': tickers, 'units': held, 'cost': cost, 'realized': realized})
+    # back to the date order of df, without the carried over positions
+    dfledger = dfledger.iloc[np.argsort(order, kind='stable')[seeds:]]
+
+    return dfledger.set_index(df.index)
+
+
+def xirr(amounts, dates, guess=0.1, tol=1e-10, maxiter=50):
+    """
+    Annual money-weighted return (XIRR) of dated cash flows: the rate where sum(amount / (1 + rate)^years) = 0.
+    Every row of amounts is solved at the same time with Newton's method over a shared row of dates; rows Newton does
+    not converge on are solved by bisection. Deposits are negative, withdrawals and the final value positive
+    :param amounts: cash flows, one row per series [n] or [series x n]
+    :param dates: dates of the cash flows [n]
+    :param guess:
+    :param tol:
+    :param maxiter:
+    :return: rates as fractions, NaN when a row has no solution
+    """
+
+    amounts = np.atleast_2d(np.asarray(amounts, dtype=float))
+    dates = pd.DatetimeIndex(dates)
+    years = np.asarray((dates - dates.min()).days, dtype=float) / 365.0
+    # a rate is accepted only when it zeroes the NPV relative to the size of the cash flows
+    scale = np.abs(amounts).sum(axis=1)
+
+    def npv(rate):
+        return (amounts * (1 + rate[:, None]) ** -years).sum(axis=1)
+
+    # without both deposits and withdrawals there is no rate
+    solvable = (amounts > 0).any(axis=1) & (amounts < 0).any(axis=1)
+
+    rate = np.full(len(amounts), guess)
+    active = solvable.copy()
+    with np.errstate(all='ignore'):
+        for _ in range(maxiter):
+            discount = (1 + rate[:, None]) ** -years
+            value = (amounts * discount).sum(axis=1)
+            slope = -(years * amounts * discount).sum(axis=1) / (1 + rate)
+            # a flat or overflowing slope means Newton diverged, those rows are left to bisection
+            active &= np.isfinite(rate) & np.isfinite(slope) & (slope != 0)
+            step = np.where(active, value / np.where(active, slope, 1), 0)
+            # keep the rate above -100%
+            rate = np.where(active, np.maximum(rate - step, (rate - 1) / 2), rate)
+            active &= np.abs(step) >= tol
+            if not active.any():
+                break
+
+        converged = solvable & np.isfinite(rate) & (rate > -1) & (np.abs(npv(rate)) <= 1e-6 * scale)
+
+        # bisection for the other rows, where the bracket has a sign change
+        low = np.full(len(amounts), -0.9999)
+        high = np.full(len(amounts), 100.0)
+        lowvalue = npv(low)
+        todo = solvable & ~converged & (np.sign(lowvalue) != np.sign(npv(high)))
+        if todo.any():
+            for _ in range(200):
+                mid = (low + high) / 2
+                midvalue = npv(mid)
+                left = np.sign(midvalue) == np.sign(lowvalue)
+                low = np.where(left, mid, low)
+                lowvalue = np.where(left, midvalue, lowvalue)
+                high = np.where(left, high, mid)
+            rate = np.where(todo, (low + high) / 2, rate)
+
+        valid = solvable & np.isfinite(rate) & (rate > -1) & (np.abs(npv(rate)) <= 1e-6 * scale)
+
+    return np.where(valid, rate, np.nan)
+
+
 def printf(str1, str2="", str3=""):
     try:
         val = float(str2)
@@ -39,13 +479,22 @@ class Retirementportfolio:
     # gencontrib()                        - generates contribution dataframe in the format ['Date', 'Contribution']
     # compareportfolio(dfcontrib, TICKER) - compares 401k performance with that of a single ticker symbol
     # comparereturn(dfcontrib, TICKER)    - compares current portfolio return to that of a single stock portfolio
+    # getreturns(dfcontrib, TICKERS)      - returns of single stock portfolios for many tickers in one pass
+    # getxirr()                           - money-weighted annual return of the portfolio
+    # getnav()                            - daily portfolio value, time-weighted return and drawdown
+    # holdings()                          - units, cost basis, gains and dividend yield per fund
     # summary()                           - returns portfolio summary as a Series with the financials as the index
 
     # internal methods not callable
     # exporttransactions()                - exports transactions from quicken files into an internal dataframe
+    # qfxmanifest()                       - loads the manifest of already imported quicken files
+    # cashflows()                         - dated cash flows of the portfolio for the XIRR
+    # derived()                           - tables derived from rawdata, cached until rawdata is replaced
+    # ledger()                            - positions and cost basis per fund, updated with new transactions only
+    # getpricematrix()                    - loads Close prices of many tickers into a Date x ticker matrix
     # maxcontrib()                        - fetches maximum allowed contribution for the year
 
-    def __init__(self, importquicken=True, forceimportquicken=False, verbose=True):
+    def __init__(self, importquicken=True, forceimportquicken=False, workers=1, streaming=False, verbose=True):
 
         if verbose:
             print("Loading module Retirementportfolio")
@@ -63,21 +512,23 @@ class Retirementportfolio:
         self.portfoliovalue = settings['portfoliovalue']
         self.portfolio_allocation_history = settings['portfolio_allocation_history']
 
-        csvfile = os.path.basename(self.alldatafile)
-        self.verbose = verbose
+        # manifest of imported quicken files [file, size, mtime_ns, sha256] kept next to the 401kexport CSV
+        self.qfxmanifestfile = os.path.splitext(self.alldatafile)[0] + '_manifest.csv'
+        # daily NAV series rebuilt from the transactions by getnav()
+        self.navfile = os.path.join(self.outputdir, 'portfolio_nav.csv')
+        # positions and cost basis per fund kept by ledger()
+        self.ledgerfile = os.path.join(self.outputdir, 'holdings_ledger.csv')
 
-        # override [importquicken=True] if quicken files were very recently imported and forceimportquicken = False
-        if dt.datetime.fromtimestamp(os.path.getmtime(self.alldatafile)).date() == dt.date.today() \
-                and not forceimportquicken:
-            if verbose:
-                print(csvfile + " already imported today. Ignoring [importquicken=True]")
-            importquicken = False
+        self.verbose = verbose
 
+        # only new or changed quicken files are parsed, so importing on every run is cheap
+        # forceimportquicken = True ignores the manifest and re-imports every file
         if importquicken:
-            self.rawdata = self.importquicken(self.alldatafile)
+            self.rawdata = self.importquicken(self.alldatafile, incremental=not forceimportquicken, workers=workers,
+                                              streaming=streaming)
         else:
-            if os.path.exists(self.alldatafile):
-                self.rawdata = pd.read_csv(self.alldatafile, parse_dates=True, header=0)
+            if os.path.exists(transactionstore(self.alldatafile)) or os.path.exists(self.alldatafile):
+                self.rawdata = loadtransactions(self.alldatafile)
             else:
                 if verbose:
                     print(self.alldatafile + " not found")
@@ -85,9 +536,41 @@ class Retirementportfolio:
                 exit(-2)
             # self.dfcontrib = self.gencontrib(self.rawdata)
 
-    def importquicken(self, csvfile, exporttocsv=True):
+    @property
+    def rawdata(self):
+        """Transaction table. Assign a new table to change it: the derived tables are cached until then"""
+        return self._rawdata
+
+    @rawdata.setter
+    def rawdata(self, df):
+        self._rawdata = df
+        self._derived = {}
+
+    def derived(self, name, build):
+        """
+        Returns the table build(self.rawdata), building it on first use and caching it until rawdata is replaced.
+        Callers get a shallow copy on read-only data (see readonlytable()): replacing its columns does not change the
+        cache and changing its values in place raises, or copies them under copy-on-write. Where the data cannot be
+        shared read-only callers get a deep copy, so the cache cannot be changed by callers on any pandas version
+        :param name:
+        :param build: function of the transaction table
+        :return: df
+        """
+
+        if name not in self._derived:
+            self._derived[name] = readonlytable(build(self.rawdata))
+
+        df, shared = self._derived[name]
+        return df.copy(deep=False) if shared else df.copy()
+
+    def importquicken(self, csvfile, exporttocsv=True, incremental=True, workers=1, streaming=False):
         """
         imports and merges all quicken files in the directory and exports the merged data to a CSV file
+        When incremental=True only quicken files that are new or changed since the last import (according to the
+        manifest) are parsed and their transactions are merged into the existing CSV file
+        When workers > 1 the quicken files are parsed in a pool of worker processes
+        When streaming=True the quicken files are read chunk by chunk with iterqfx() instead of OfxParser
+        The merged data is kept in a columnar store next to the CSV file, see savetransactions()
         """
 
         verbose = self.verbose
@@ -100,8 +583,15 @@ class Retirementportfolio:
         files = []
         for e in ext:
             files.extend(glob(e))
+        files = sorted(set(files))
+
+        incremental = incremental and (os.path.exists(transactionstore(csvfile)) or os.path.exists(csvfile))
 
         if len(files) == 0:
+            if incremental:
+                if verbose:
+                    print("No QFX files found in " + self.mykplandata_dir + ". Using previously imported data.")
+                return loadtransactions(csvfile)
             if verbose:
                 print("No QFX files found in working directory:" + self.PARENT_DIRECTORY)
                 print("Either download the portfolio data manually to this directory or "
@@ -110,111 +600,130 @@ class Retirementportfolio:
                 print("Exiting ...")
             exit(-2)
 
+        dfmanifest = self.qfxmanifest() if incremental else pd.DataFrame()
+        manifest = {row['file']: row for _, row in dfmanifest.iterrows()}
+
+        changedfiles = []
+        newmanifest = []
         for qfx_file in files:
+            stat = os.stat(qfx_file)
+            entry = manifest.get(qfx_file)
+            # size and mtime unchanged: trust the manifest without hashing the file
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                newmanifest.append([qfx_file, stat.st_size, stat.st_mtime_ns, entry['sha256']])
+                continue
+            # files are re-downloaded by mykplan.py so the mtime changes even if the content does not
+            sha256 = filehash(qfx_file)
+            if entry is None or entry['sha256'] != sha256:
+                changedfiles.append(qfx_file)
+            newmanifest.append([qfx_file, stat.st_size, stat.st_mtime_ns, sha256])
+
+        dfnewmanifest = pd.DataFrame(newmanifest, columns=['file', 'size', 'mtime_ns', 'sha256'])
+
+        if len(changedfiles) == 0:
+            if verbose:
+                print("No new or changed QFX files since the last import")
+            dfnewmanifest.to_csv(self.qfxmanifestfile, index=False)
+            df = loadtransactions(csvfile)
+            # first run after an upgrade: build the columnar store from the CSV file
+            if feather is not None and not os.path.exists(transactionstore(csvfile)):
+                savetransactions(df, csvfile, exporttocsv=False)
+            return df
+
+        if incremental:
+            dfs.append(normalisetransactions(loadtransactions(csvfile)))
+
+        if workers > 1 and len(changedfiles) > 1:
             if verbose:
-                print("Reading ... " + qfx_file)
-            f = open(qfx_file, "r", encoding="utf-8")
-            qfx = OfxParser.parse(f)
-            df1 = self.exporttransactions(qfx)
-            dfs.append(df1)
+                print("Reading " + str(len(changedfiles)) + " files with " + str(workers) + " workers")
+            # map() returns the results in the order of changedfiles so the merged data is deterministic
+            with ProcessPoolExecutor(max_workers=min(workers, len(changedfiles))) as executor:
+                dfs.extend(executor.map(partial(parseqfx, streaming=streaming), changedfiles))
+        else:
+            for qfx_file in changedfiles:
+                if verbose:
+                    print("Reading ... " + qfx_file)
+                if streaming:
+                    dfs.extend(normalisetransactions(df) for df in iterqfx(qfx_file))
+                else:
+                    dfs.append(parseqfx(qfx_file))
 
         df = pd.concat(dfs)
         df = df.drop_duplicates()
         # df = df.sort_values(by=['Date']).set_index('Date')
-        df = df.sort_values(by=['Date'])
+        df = typetransactions(df.sort_values(by=['Date'], kind='stable'))
 
-        if exporttocsv:
-            # export data to CSV
-            df.to_csv(csvfile, index=False)
-            if verbose:
-                print("Output written to: " + csvfile)
+        savetransactions(df, csvfile, exporttocsv)
+        # the manifest is only valid for the transaction store it describes
+        dfnewmanifest.to_csv(self.qfxmanifestfile, index=False)
+        if verbose and exporttocsv:
+            print("Output written to: " + csvfile)
 
         return df
 
-    # exports transactions from quicken files into an internal dataframe. internal calls only
-    @staticmethod
-    def exporttransactions(qfx):
-
-        # get the data headers
-        ll = dir(qfx.account.statement.transactions[0])
-        regex = re.compile(r'^(?!__)')
-        # props starting with __ like __reduce__ are methods not data. Filter them out
-        props = list(filter(regex.search, ll))
-        props = props[1:]
-
-        alltransactions = []
-        for t in qfx.account.statement.transactions:
-            singletransaction = []
-            for p in props:
-                singletransaction.append(getattr(t, p))
-            alltransactions.append(singletransaction)
-
-        tempdf = pd.DataFrame(alltransactions, columns=props)
-
-        # Dropping few columns manually. However, the original data is fully imported in tempdf.
-        # We can test for new data in dropped columns by tempdf[colname].unique()
-
-        df_transactions = tempdf[
-            ['settleDate', 'security', 'income_type', 'memo', 'type', 'unit_price', 'units', 'total']]
-        df_transactions = df_transactions.rename(columns={'settleDate': 'Date'})
+    def qfxmanifest(self):
+        """
+        Loads the manifest of already imported quicken files in the format [file, size, mtime_ns, sha256]
+        :return: dfmanifest
+        """
 
-        securities = qfx.security_list
+        if os.path.exists(self.qfxmanifestfile):
+            return pd.read_csv(self.qfxmanifestfile, dtype={'file': str, 'sha256': str})
 
-        listofsecurities = []
-        for s in securities:
-            listofsecurities.append([s.uniqueid, s.ticker, s.name])
+        return pd.DataFrame(columns=['file', 'size', 'mtime_ns', 'sha256'])
 
-        df_securities = pd.DataFrame(listofsecurities, columns=['security', 'ticker', 'name'])
+    # exports transactions from quicken files into an internal dataframe. internal calls only
+    @staticmethod
+    def exporttransactions(qfx):
 
-        df_transactions = df_transactions.merge(df_securities, on='security')
-        df_transactions = df_transactions[['Date', 'security', 'ticker', 'name', 'income_type', 'memo',
-                                           'units', 'unit_price']]
+        # map security ids to (ticker, name) with a dict lookup instead of merging dataframes
+        securities = {s.uniqueid: (s.ticker, s.name) for s in qfx.security_list}
+
+        # transactions of securities missing from the security list are dropped, like the inner merge used to do
+        transactions = [t for t in qfx.account.statement.transactions if getattr(t, 'security', None) in securities]
+
+        # read only the fields that are exported instead of every property of every transaction
+        df_transactions = pd.DataFrame({
+            'Date': [t.settleDate for t in transactions],
+            'security': [t.security for t in transactions],
+            'ticker': [securities[t.security][0] for t in transactions],
+            'name': [securities[t.security][1] for t in transactions],
+            'income_type': [t.income_type for t in transactions],
+            'memo': [t.memo for t in transactions],
+            'units': [t.units for t in transactions],
+            'unit_price': [t.unit_price for t in transactions]},
+            columns=['Date', 'security', 'ticker', 'name', 'income_type', 'memo', 'units', 'unit_price'])
         df_transactions['price'] = df_transactions['units'] * df_transactions['unit_price']
 
-        df_transactions = df_transactions.sort_values(by=['Date'])
+        df_transactions = df_transactions.sort_values(by=['Date'], kind='stable')
 
         return df_transactions
 
     def gencontrib(self, df_portfoliodata=pd.DataFrame()):
         """
         Generates contribution dataframe in the format [Date, Contribution]
+        The table of self.rawdata is built once and cached until rawdata is replaced
         :param df_portfoliodata:
         :return:
         """
 
         if df_portfoliodata.empty:
-            df_portfoliodata = self.rawdata
-
-        # find total contribution and dividends
-        df_portfoliodata['Date'] = pd.to_datetime(df_portfoliodata['Date'])
-        df_portfoliodata['Date'] = pd.to_datetime(list(map(lambda x: x.date(), df_portfoliodata['Date'])))
+            return self.derived('contrib', contributions)
 
-        dfcontrib = df_portfoliodata[df_portfoliodata['memo'] == 'Contribution'][['Date', 'price']]
-        dfcontrib.rename({'price': 'contrib'}, axis=1, inplace=True)
-        # make the columns float
-        dfcontrib['contrib'] = dfcontrib['contrib'].astype('float')
-
-        dfcontrib = dfcontrib.groupby('Date').sum()
-        dfcontrib.reset_index(inplace=True)
-        # dfcontrib.set_index('Date', inplace=True)
-
-        return dfcontrib
+        return contributions(df_portfoliodata)
 
     def getdividends(self, df_portfoliodata=pd.DataFrame()):
         """
         Generate a dividend distribution table with the datafame structure [Date, name, dividend]
+        The table of self.rawdata is built once and cached until rawdata is replaced
         :param df_portfoliodata:
         :return: dfdividends
         """
 
         if df_portfoliodata.empty:
-            df_portfoliodata = self.rawdata
-
-        dfdividends = df_portfoliodata[(df_portfoliodata['memo'] == 'Dividends and Earnings') &
-                                       (df_portfoliodata['price'] > 5)][['Date', 'name', 'price']]
-        dfdividends = dfdividends.rename(columns={'price': 'dividend'})
+            return self.derived('dividends', dividends)
 
-        return dfdividends
+        return dividends(df_portfoliodata)
 
     def compareportfolio(self, dfcontrib, tickr='SPY', fetchincompletedata=True):
         """
@@ -245,9 +754,9 @@ class Retirementportfolio:
         startdate = dfcontrib['Date'].iloc[0]
         enddate = dfcontrib['Date'].iloc[-1]
 
-        stock = gd.GetStockData(ticker=tickr, path=self.stockdata, fetchincompletedata=fetchincompletedata,
-                                verbose=verbose)
-        stockdata = stock.getdata(startdate, enddate)
+        # 'Close vs Close'. We want Close as we want to capture the return due to dividend payouts
+        stockdata = pricecache.getclose(tickr, startdate, enddate, path=self.stockdata,
+                                        fetchincompletedata=fetchincompletedata, verbose=verbose)
 
         if len(stockdata) < 2:  # error: no ticker data
             return pd.DataFrame()
@@ -255,10 +764,6 @@ class Retirementportfolio:
         stockdata = stockdata.reset_index()
         dfcontrib = dfcontrib.reset_index()
 
-        # 'Close vs Close'. We want Close as we want to capture the return due to dividend payouts
-        # get rid of extra data like volume etc.
-        stockdata = stockdata[['Date', 'Close']]
-
         # We actually want to know what is the price of SPY on the days we contributed to the 401k portfolio.
         # Direct comparison between unequal sized dataframes are not possible. Instead if we merge (inner=intersection)
         # on the Date column then only the days of contribution will be extracted from the SPY data
@@ -303,12 +808,17 @@ class Retirementportfolio:
 
     def getcurrentportfoliovalue(self):
         """
+        Returns the latest portfolio value. Only the last row of the append-only log is read, once per process and
+        again only when the file changes
         :return: currentval
         """
 
+        lastrow = None
         if os.path.exists(self.portfoliovalue):
-            df_portfoliovalue = pd.read_csv(self.portfoliovalue)
-            currentval = float(df_portfoliovalue['PortfolioValue401k'].iloc[-1])
+            lastrow = readcached(self.portfoliovalue, historylog.lastrow)
+
+        if lastrow is not None:
+            currentval = float(lastrow['PortfolioValue401k'])
         else:
             rflogs.error(self.portfoliovalue + " not found")
             currentval = input("What is the current value of portfolio: ")
@@ -344,30 +854,332 @@ class Retirementportfolio:
 
         return [tickr, excessreturn, yoyreturn, totreturn]
 
+    def getpricematrix(self, dates, tickers, fetchincompletedata=True, progress=False):
+        """
+        Loads the Close price of every ticker on the given dates into a single Date x ticker matrix.
+        Prices missing on a date, and tickers with less than 2 prices in the date range, are NaN
+        :param dates:
+        :param tickers:
+        :param fetchincompletedata:
+        :param progress: show a progress bar
+        :return: dfprices
+        """
+
+        dates = pd.DatetimeIndex(dates)
+        startdate = dates[0]
+        enddate = dates[-1]
+
+        prices = np.full((len(dates), len(tickers)), np.nan)
+        for j, tickr in enumerate(tqdm(tickers, disable=not progress)):
+            close = pricecache.getclose(tickr, startdate, enddate, path=self.stockdata,
+                                        fetchincompletedata=fetchincompletedata, verbose=self.verbose)
+            if len(close) < 2:  # error: no ticker data
+                continue
+            prices[:, j] = close.reindex(dates).to_numpy()
+
+        return pd.DataFrame(prices, index=dates, columns=list(tickers))
+
+    def getreturns(self, dfcontrib, tickers, fetchincompletedata=True, progress=False):
+        """
+        Calculates ['ticker', 'excessreturn', 'yoyreturn', 'totreturn'] for many tickers in one pass.
+        Gives the same numbers as getreturn() but the prices are loaded once into a Date x ticker matrix and the
+        returns of all tickers are computed with array operations
+        :param dfcontrib:
+        :param tickers:
+        :param fetchincompletedata:
+        :param progress: show a progress bar while loading prices
+        :return: dfreturns ['ticker', 'excessreturn', 'yoyreturn', 'totreturn', 'xirr']
+        """
+
+        dfprices = self.getpricematrix(dfcontrib['Date'], tickers, fetchincompletedata, progress)
+        prices = dfprices.to_numpy()
+        contrib = dfcontrib['contrib'].to_numpy(dtype='float')
+
+        # units bought on every contribution date. Like the inner merge in compareportfolio(), contributions on
+        # dates without a price are not invested
+        totalunits = np.nansum(contrib[:, None] / prices, axis=0)
+        lastprice = dfprices.ffill().to_numpy()[-1]
+        ret = r(totalunits * lastprice)
+
+        # error: no ticker data
+        valid = ~np.isnan(ret) & (ret != 0)
+        ret = ret[valid]
+
+        # XIRR of all tickers at once: the invested contributions go out, the final value comes back on the last date
+        amounts = np.where(np.isnan(prices[:, valid]), 0, -contrib[:, None]).T
+        amounts = np.hstack([amounts, ret[:, None]])
+        xirrs = xirr(amounts, list(dfcontrib['Date']) + [dfcontrib['Date'].iloc[-1]])
+
+        currentval = float(self.getcurrentportfoliovalue())
+        timeindays = (dfcontrib['Date'].iloc[-1] - dfcontrib['Date'].iloc[0]).days
+        totalcontrib = contrib.sum()
+
+        dfreturns = pd.DataFrame({'ticker': dfprices.columns[valid],
+                                  'excessreturn': np.round(ret - currentval, 2),
+                                  'yoyreturn': np.round((np.exp(np.log(ret / totalcontrib) / timeindays) - 1)
+                                                        * 365 * 100, 2),
+                                  'totreturn': np.round((ret / totalcontrib - 1) * 100, 2),
+                                  'xirr': np.round(xirrs * 100, 2)})
+
+        return dfreturns
+
     @staticmethod
-    def maxcontrib():
+    def maxcontrib(maxcontribfile='maxcontrib.csv'):
         """
         Fetches maximum allowed contribution for the year
+        The local table [Year, Contrib] is read once per process. The web page is scraped only when this year is
+        missing from the table and the scraped limit is saved to the table, so later runs work offline
         :return: maxcontrib
         """
 
-        maxcontribfile = 'maxcontrib.csv'
+        year = dt.date.today().year
 
+        dfmaxcontrib = pd.DataFrame(columns=['Year', 'Contrib'])
         if os.path.exists(maxcontribfile):
-            dfmaxcontrib = pd.read_csv(maxcontribfile)
-            maxcontrib = dfmaxcontrib[(dfmaxcontrib['Year'] == dt.date.today().year)]['Contrib']
-        else:
-            # For future years, the limit may be indexed for inflation, increasing in increments of $500
-            # maxcontrib = 19000 + 500*(dt.date.today().year - 2019)
-
+            dfmaxcontrib = readcached(maxcontribfile, pd.read_csv)
+            maxcontrib = dfmaxcontrib[(dfmaxcontrib['Year'] == year)]['Contrib']
+            if len(maxcontrib) > 0:
+                return int(maxcontrib.iloc[0])
+
+        # For future years, the limit may be indexed for inflation, increasing in increments of $500
+        # maxcontrib = 19000 + 500*(dt.date.today().year - 2019)
+        try:
             url5 = 'https://www.pensions123.com/index.php/401k-limit-graph'
             df = pd.read_html(url5)[0]
             df.columns = df.iloc[1]
             df = df.drop([0, 1])
             maxcontrib = int(df["401(k) &402(g)(1)"].iloc[0])
+        except (OSError, ValueError, KeyError, IndexError) as error:
+            if len(dfmaxcontrib) == 0:
+                raise
+            # offline: limits never decrease so the latest known limit is a safe estimate
+            maxcontrib = int(dfmaxcontrib.sort_values('Year')['Contrib'].iloc[-1])
+            rflogs.error("Could not fetch the contribution limit for " + str(year) + " (" + str(error) +
+                         "). Using " + str(maxcontrib))
+            return maxcontrib
+
+        dfmaxcontrib = pd.concat([dfmaxcontrib, pd.DataFrame({'Year': [year], 'Contrib': [maxcontrib]})],
+                                 ignore_index=True)
+        dfmaxcontrib.to_csv(maxcontribfile, index=False)
 
         return maxcontrib
 
+    def cashflows(self, dividends=False):
+        """
+        Dated cash flows of the portfolio in the format ['Date', 'amount']: contributions are negative and the current
+        value is positive on the date of the last transaction.
+        Dividends are reinvested in the 401k, so they are already part of the current value. dividends=True also
+        counts them as money paid out, for portfolios that do not reinvest them
+        :param dividends:
+        :return: dfcashflows
+        """
+
+        dfcontrib = self.gencontrib()
+        frames = [pd.DataFrame({'Date': dfcontrib['Date'], 'amount': -dfcontrib['contrib']})]
+        if dividends:
+            dfdividend = self.getdividends()
+            frames.append(pd.DataFrame({'Date': dfdividend['Date'], 'amount': dfdividend['dividend'].astype(float)}))
+        frames.append(pd.DataFrame({'Date': [pd.Timestamp(self.rawdata['Date'].max()).normalize()],
+                                    'amount': [float(self.getcurrentportfoliovalue())]}))
+
+        return pd.concat(frames, ignore_index=True).sort_values('Date', kind='stable').reset_index(drop=True)
+
+    def getxirr(self, dividends=False):
+        """
+        Money-weighted annual return of the portfolio in percent. Unlike the YoY return it accounts for the date of
+        every contribution
+        :param dividends: see cashflows()
+        :return: xirr
+        """
+
+        dfcashflows = self.cashflows(dividends)
+
+        return r(xirr(dfcashflows['amount'], dfcashflows['Date'])[0] * 100)
+
+    def getnav(self, fetchincompletedata=True, update=True):
+        """
+        Rebuilds the daily value of the portfolio (NAV) on business days from the transactions: the units held in
+        every fund, a cumulative sum per fund, are joined as-of every day with the Close price of the fund. Days without
+        a Close price use the last transaction unit_price of the fund.
+        The daily return excludes the contributions of the day, so twr is the time-weighted growth of 1 dollar and
+        drawdown is measured on it.
+        The series is saved to navfile with the cumulative number of transactions up to every day. On the next call
+        only the days from the first day whose transaction count changed, or else from the last saved day, are
+        computed again
+        :param fetchincompletedata:
+        :param update: reuse the saved series [Default=True]
+        :return: dfnav in the format [Date, value, flow, dailyreturn, twr, drawdown, transactions]
+        """
+
+        df = self.rawdata[self.rawdata['ticker'].notna() & self.rawdata['units'].notna()]
+        dates = pd.to_datetime(df['Date']).dt.normalize()
+        tickers = df['ticker'].astype(str).to_numpy()
+        funds = sorted(set(tickers))
+
+        # business days up to today; weekend transactions count from the next business day
+        enddate = pd.offsets.BDay().rollforward(max(pd.Timestamp.today().normalize(), dates.max()))
+        days = pd.bdate_range(dates.min(), enddate, name='Date')
+        dayidx = days.searchsorted(dates.to_numpy(), side='left')
+        transactions = np.bincount(dayidx, minlength=len(days)).cumsum()
+
+        # first day to compute: the saved days are kept until the transaction counts differ, the last saved day is
+        # always computed again since its prices may have been incomplete
+        start = 0
+        dfprevious = None
+        if update and os.path.exists(self.navfile):
+            dfprevious = pd.read_csv(self.navfile, parse_dates=['Date'])
+            if len(dfprevious) > 0 and dfprevious['Date'].iloc[0] == days[0]:
+                n = min(len(dfprevious), len(days))
+                changed = np.flatnonzero(dfprevious['transactions'].to_numpy()[:n] != transactions[:n])
+                start = max(min(changed[0] if len(changed) > 0 else n, n - 1), 0)
+            else:
+                dfprevious = None
+
+        # cumulative units and last unit_price of every fund on the days with transactions
+        dftransactions = pd.DataFrame({'day': dayidx, 'ticker': tickers, 'units': df['units'].to_numpy(dtype=float),
+                                       'unit_price': df['unit_price'].to_numpy(dtype=float)})
+        grouped = dftransactions.groupby(['ticker', 'day'])
+        dfunits = grouped['units'].sum().groupby(level='ticker').cumsum().unstack('ticker')
+        dfunits = dfunits.reindex(columns=funds).ffill().fillna(0)
+        dfunitprice = grouped['unit_price'].last().unstack('ticker').reindex(columns=funds).ffill()
+
+        # as-of join of the days to compute with the transaction days
+        asof = np.searchsorted(dfunits.index.to_numpy(), np.arange(start, len(days)), side='right') - 1
+        units = np.where(asof[:, None] >= 0, dfunits.to_numpy()[np.clip(asof, 0, None)], 0)
+        unitprice = np.where(asof[:, None] >= 0, dfunitprice.to_numpy()[np.clip(asof, 0, None)], np.nan)
+
+        # load a few days before the first day so the Close prices can be carried forward into it
+        lookback = max(start - 10, 0)
+        prices = self.getpricematrix(days[lookback:], funds, fetchincompletedata).ffill().to_numpy()[start - lookback:]
+        prices = np.where(np.isnan(prices), unitprice, prices)
+        value = np.where(units != 0, units * prices, 0)
+        value = np.nansum(value, axis=1)
+
+        dfcontrib = self.gencontrib()
+        flowidx = days.searchsorted(dfcontrib['Date'].to_numpy(), side='left')
+        flow = np.bincount(flowidx, weights=dfcontrib['contrib'].to_numpy(dtype=float), minlength=len(days))
+        flow = flow[start:len(days)]
+
+        if start > 0:
+            previousvalue = dfprevious['value'].iloc[start - 1]
+            previoustwr = dfprevious['twr'].iloc[start - 1]
+            peak = dfprevious['twr'].iloc[:start].max()
+        else:
+            previousvalue, previoustwr, peak = 0.0, 1.0, 1.0
+
+        lastvalue = np.concatenate([[previousvalue], value[:-1]])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dailyreturn = np.where(lastvalue > 0, (value - flow) / lastvalue - 1, 0.0)
+        twr = previoustwr * np.cumprod(1 + dailyreturn)
+        drawdown = twr / np.maximum(peak, np.maximum.accumulate(twr)) - 1
+
+        dfnav = pd.DataFrame({'Date': days[start:], 'value': value, 'flow': flow, 'dailyreturn': dailyreturn,
+                              'twr': twr, 'drawdown': drawdown, 'transactions': transactions[start:]})
+        if start > 0:
+            dfnav = pd.concat([dfprevious.iloc[:start], dfnav], ignore_index=True)
+
+        dfnav.to_csv(self.navfile + '.tmp', index=False)
+        os.replace(self.navfile + '.tmp', self.navfile)
+
+        return dfnav
+
+    def ledger(self, df_portfoliodata, update=True):
+        """
+        Units, cost basis, realized gain and dividends per fund in the format LEDGERCOLUMNS, saved to ledgerfile.
+        When every transaction counted in the saved ledger is still there and the new ones are all dated later, only
+        the new transactions are run through costbasis(), starting from the saved positions
+        :param df_portfoliodata: transactions sorted by date
+        :param update: reuse the saved ledger [Default=True]
+        :return: dfledger indexed by ticker
+        """
+
+        df = df_portfoliodata[df_portfoliodata['ticker'].notna() & df_portfoliodata['units'].notna()]
+        dates = pd.to_datetime(df['Date'])
+
+        dfprevious = None
+        if update and os.path.exists(self.ledgerfile):
+            dfprevious = pd.read_csv(self.ledgerfile, dtype={'ticker': str}, parse_dates=['lastdate'])
+            dfprevious = dfprevious.set_index('ticker')
+            if len(dfprevious) == 0 or (dates <= dfprevious['lastdate'].iloc[0]).sum() != \
+                    dfprevious['transactions'].iloc[0]:
+                dfprevious = None
+
+        if dfprevious is not None:
+            df = df[dates > dfprevious['lastdate'].iloc[0]]
+            dfcost = costbasis(df, dfprevious['units'], dfprevious['costbasis'])
+        else:
+            dfcost = costbasis(df)
+
+        tickers = df['ticker'].astype(str)
+        dividend = (df['memo'] == 'Dividends and Earnings').to_numpy()
+        grouped = pd.DataFrame({'ticker': tickers, 'name': df['name'].astype(str), 'units': dfcost['units'],
+                                'costbasis': dfcost['cost'], 'realizedgain': dfcost['realized'],
+                                'dividends': np.where(dividend, df['units'].to_numpy(dtype=float) *
+                                                      df['unit_price'].to_numpy(dtype=float), 0.0),
+                                'lastprice': df['unit_price'].to_numpy(dtype=float)}).groupby('ticker', sort=True)
+        dfledger = grouped[['name', 'units', 'costbasis', 'lastprice']].last()
+        dfledger[['realizedgain', 'dividends']] = grouped[['realizedgain', 'dividends']].sum()
+
+        if dfprevious is not None:
+            totals = dfledger[['realizedgain', 'dividends']].add(dfprevious[['realizedgain', 'dividends']],
+                                                                 fill_value=0)
+            dfledger = dfledger.combine_first(dfprevious[dfledger.columns])
+            dfledger[['realizedgain', 'dividends']] = totals
+            ntransactions = dfprevious['transactions'].iloc[0] + len(df)
+            lastdate = dfprevious['lastdate'].iloc[0] if len(df) == 0 else dates.max()
+        else:
+            ntransactions = len(df)
+            lastdate = dates.max()
+
+        dfledger['transactions'] = ntransactions
+        dfledger['lastdate'] = lastdate
+        dfledger = dfledger.rename_axis('ticker').sort_index()
+
+        dfledger.reset_index()[LEDGERCOLUMNS].to_csv(self.ledgerfile + '.tmp', index=False)
+        os.replace(self.ledgerfile + '.tmp', self.ledgerfile)
+
+        return dfledger
+
+    def holdings(self, prices=None):
+        """
+        Current holdings per fund in the format [ticker, name, units, avgcost, costbasis, price, value, realizedgain,
+        unrealizedgain, dividends, dividendyield]. The ledger is built once and cached until rawdata is replaced.
+        dividendyield is the dividends of the 12 months up to the last transaction over the value, in percent
+        :param prices: prices per ticker (dict or Series) [Default=the last unit_price of every fund]
+        :return: dfholdings
+        """
+
+        dfholdings = self.derived('ledger', self.ledger)
+
+        price = dfholdings['lastprice']
+        if prices is not None:
+            price = pd.Series(prices, dtype=float).reindex(dfholdings.index).fillna(price)
+
+        # dividends of the last 12 months, read from the end of the date-sorted transactions
+        df = self.rawdata
+        lastdate = pd.Timestamp(df['Date'].iloc[-1])
+        df = df.iloc[np.searchsorted(pd.to_datetime(df['Date']).to_numpy(), np.datetime64(lastdate - pd.DateOffset(
+            years=1))):]
+        df = df[(df['memo'] == 'Dividends and Earnings') & df['ticker'].notna()]
+        trailing = pd.Series(df['units'].to_numpy(dtype=float) * df['unit_price'].to_numpy(dtype=float),
+                             index=df['ticker'].astype(str).to_numpy()).groupby(level=0).sum()
+
+        value = dfholdings['units'] * price
+        dfholdings = pd.DataFrame({'name': dfholdings['name'],
+                                   'units': dfholdings['units'],
+                                   'avgcost': dfholdings['costbasis'] / dfholdings['units'].where(
+                                       dfholdings['units'] != 0),
+                                   'costbasis': dfholdings['costbasis'],
+                                   'price': price,
+                                   'value': value,
+                                   'realizedgain': dfholdings['realizedgain'],
+                                   'unrealizedgain': value - dfholdings['costbasis'],
+                                   'dividends': dfholdings['dividends'],
+                                   'dividendyield': trailing.reindex(dfholdings.index).fillna(0) /
+                                   value.where(value != 0) * 100})
+
+        return r(dfholdings).rename_axis('ticker').reset_index()
+
     def summary(self):
         """Return portfolio summary as a Series with the financials as the index"""
 
@@ -393,14 +1205,15 @@ class Retirementportfolio:
         totaltime = (enddate - startdate).days
         yearsinvested = totaltime / 365.25
         yoyreturn = str(r((np.exp(np.log(currentval / totalcontrib) / yearsinvested) - 1) * 100)) + "%"
+        xirrreturn = str(self.getxirr()) + "%"
 
         yearsinvested_str = str(np.round(yearsinvested)) + " years " + str(
             totaltime - np.round(yearsinvested) * 365) + " days"
 
-        summary = pd.Series([currentval, totalcontrib, totaldiv, yearsinvested_str, totalret, yoyreturn, ytdcontrib,
-                             maxc, allowedcontrib],
+        summary = pd.Series([currentval, totalcontrib, totaldiv, yearsinvested_str, totalret, yoyreturn, xirrreturn,
+                             ytdcontrib, maxc, allowedcontrib],
                             index=["Current portfolio value", "Total Contribution", "Total Dividends",
-                                   "Total time in the market", "Total return", "YoY return", "YTD Contribution",
-                                   "Max Contribution for this year", "Allowed Contribution left"])
+                                   "Total time in the market", "Total return", "YoY return", "XIRR",
+                                   "YTD Contribution", "Max Contribution for this year", "Allowed Contribution left"])
 
         return summary
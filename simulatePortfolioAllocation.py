@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 from stockanalysis import helpers
-from stockanalysis import getstockdata as gd
 
 import argparse
 import logging
+import historylog
 import retirementportfolio as rt
 import pandas as pd
 import numpy as np
@@ -25,47 +25,177 @@ def getargs():
     parser.add_argument('-v', '--verbose', help='Verbose mode [Default=Off]', action='store_true')
     parser.add_argument('-f', '--fetchincompletedata', help='Fetch incomplete data [Default=Off]', action='store_true')
     parser.add_argument('-t', '--ticker', help='Compare with ETF ticker [Default=SPY]', type=str)
+    parser.add_argument('-p', '--history', help='Replay the dated allocation snapshots in '
+                                                'portfolio_allocation_history instead of the current allocation',
+                        action='store_true')
+    parser.add_argument('-a', '--allocations', help='CSV file of candidate allocations in percent, one row per '
+                                                    'candidate and one column per fund ticker. Evaluates all rows '
+                                                    'instead of simulating the current allocation', type=str)
     args = parser.parse_args()
     return args
 
 
-def getprices(ticker, dfcontrib, fetchincompletedata=True):
+def fundvalues(dfcontrib, dfprices, weights=1.0):
     """
-    Returns a table of prices for a specific ticker symbol on the days of contribution to the portfolio
-    in the format ['Date', 'price', 'value']
-    :param ticker:
+    Returns the value of every fund when the fraction weights of every contribution is invested in that fund, as a
+    Date x fund matrix computed in one step for all funds. Contributions on dates without a price are not invested
+    and the last value is carried forward over those dates
     :param dfcontrib:
+    :param dfprices: Date x fund matrix of prices on the contribution dates
+    :param weights: fraction of the contributions invested in each fund. A scalar, a vector with one weight per fund
+                    or a Date x fund matrix of weights that change over time
+    :return: dfvalues
+    """
+
+    contrib = dfcontrib['contrib'].to_numpy(dtype='float')
+    prices = dfprices.to_numpy()
+
+    units = np.nan_to_num(contrib[:, None] * weights / prices)
+    values = np.cumsum(units, axis=0) * prices
+
+    return pd.DataFrame(values, index=dfprices.index, columns=dfprices.columns).ffill()
+
+
+def simulateweights(portfolio, dfcontrib, funds, weights, stock='SPY', fetchincompletedata=True):
+    """
+    Simulates the contribution history invested in funds with the given weights and compares it with a single ticker.
+    Prices of all funds and the ticker are loaded once into a single price matrix
+    :return: dfportfolio in the format [Date, <funds>, portfoliovalue_nodiv, dividend, sum_div, portfoliovalue_div,
+             <stock>value]
+    """
+
+    # import the dividend payouts to the portfolio. format: [Date, name, dividend]
+    dfdividends = portfolio.getdividends()
+    dfdividends = dfdividends.groupby(dfdividends['Date'].dt.normalize())['dividend'].sum()
+
+    dfprices = portfolio.getpricematrix(dfcontrib['Date'], funds + [stock], fetchincompletedata)
+
+    # weighted value of every fund
+    dfportfolio = fundvalues(dfcontrib, dfprices[funds], weights)
+    dfportfolio['portfoliovalue_nodiv'] = dfportfolio.sum(axis=1)
+
+    # include dividend payouts from 401k
+    dfportfolio = dfportfolio.join(dfdividends, how='outer')
+    dfportfolio.index.name = 'Date'
+    dfportfolio['dividend'] = dfportfolio['dividend'].fillna(0)
+    dfportfolio['sum_div'] = dfportfolio['dividend'].cumsum()
+    dfportfolio[funds + ['portfoliovalue_nodiv']] = dfportfolio[funds + ['portfoliovalue_nodiv']].ffill()
+    dfportfolio['portfoliovalue_div'] = dfportfolio['portfoliovalue_nodiv'] + dfportfolio['sum_div']
+
+    # compare portfolio performance to a single broad market ETF performance
+    dfstock = fundvalues(dfcontrib, dfprices[[stock]])
+    dfportfolio[stock + 'value'] = dfstock[stock].reindex(dfportfolio.index).ffill()
+
+    return dfportfolio.reset_index()
+
+
+def simulateallocation(portfolio, allocs, stock='SPY', fetchincompletedata=True):
+    """
+    Simulates the contribution history of the portfolio invested with the allocation in allocs and compares it with a
+    single ticker
+    :param portfolio: Retirementportfolio
+    :param allocs: dataframe in the format [fund_name, funds, allocation]
+    :param stock: ticker to compare with
+    :param fetchincompletedata:
+    :return: dfportfolio in the format [Date, <funds>, portfoliovalue_nodiv, dividend, sum_div, portfoliovalue_div,
+             <stock>value]
+    """
+
+    # import the contributions to the portfolio. format: [Date, Contribution]
+    dfcontrib = portfolio.gencontrib()
+    weights = allocs['allocation'].to_numpy(dtype='float') / 100
+
+    return simulateweights(portfolio, dfcontrib, list(allocs['funds']), weights, stock, fetchincompletedata)
+
+
+def loadallocationhistory(portfolio_allocation_history):
+    """
+    Loads the dated allocation snapshots saved by mykplan.py as a snapshot date x ticker matrix of weights that add
+    up to 1 on every date
+    :param portfolio_allocation_history: wide history file, the long-format log next to it is read when it exists
+    :return: dfweights
+    """
+
+    df = historylog.readhistory(historylog.longstore(portfolio_allocation_history),
+                                widefile=portfolio_allocation_history)
+    df = df['value'].unstack('ticker').fillna(0)
+    df = df.div(df.sum(axis=1), axis=0)
+
+    return df[df.notna().all(axis=1)]
+
+
+def simulatehistory(portfolio, stock='SPY', fetchincompletedata=True):
+    """
+    Simulates the contribution history of the portfolio replaying the dated allocation snapshots piecewise: every
+    contribution is invested with the latest snapshot on or before its date (the first snapshot before that)
+    :param portfolio: Retirementportfolio
+    :param stock: ticker to compare with
+    :param fetchincompletedata:
+    :return: dfportfolio in the format [Date, <funds>, portfoliovalue_nodiv, dividend, sum_div, portfoliovalue_div,
+             <stock>value]
+    """
+
+    dfcontrib = portfolio.gencontrib()
+    dfweights = loadallocationhistory(portfolio.portfolio_allocation_history)
+
+    # as-of join of the contribution dates to the snapshot dates
+    snapshot = np.searchsorted(dfweights.index.values, dfcontrib['Date'].values, side='right') - 1
+    weights = dfweights.to_numpy()[np.clip(snapshot, 0, None)]
+
+    return simulateweights(portfolio, dfcontrib, list(dfweights.columns), weights, stock, fetchincompletedata)
+
+
+def sweepallocations(portfolio, dfallocations, fetchincompletedata=True):
+    """
+    Evaluates many candidate allocations in one call. The value path of every fund is computed once and the final
+    values of all candidates are a single matrix product with the allocation matrix.
+    Candidates that allocate to a fund without price data get NaN
+    :param portfolio: Retirementportfolio
+    :param dfallocations: allocations in percent, one row per candidate and one column per fund ticker
     :param fetchincompletedata:
-    :return:
+    :return: dfsweep in the format [finalvalue, totreturn, yoyreturn] with the index of dfallocations
     """
 
-    # prepare data for loading and comparison
-    # transform Date column into datetime object so we can merge the dataframes - stockdata and dfcontrib
-    startdate = dfcontrib['Date'].iloc[0]
-    enddate = dfcontrib['Date'].iloc[-1]
+    dfcontrib = portfolio.gencontrib()
+    funds = list(dfallocations.columns)
 
-    stock = gd.GetStockData(ticker, fetchincompletedata=fetchincompletedata)
-    stockdata = stock.getdata(startdate, enddate)['Close']
+    dfprices = portfolio.getpricematrix(dfcontrib['Date'], funds, fetchincompletedata)
+    finalvalues = fundvalues(dfcontrib, dfprices).to_numpy()[-1]
+    nodata = np.isnan(finalvalues)
 
-    stockdata = stockdata.reset_index()
+    weights = dfallocations.to_numpy(dtype='float') / 100
+    finalvalue = weights @ np.nan_to_num(finalvalues)
+    finalvalue[(weights[:, nodata] != 0).any(axis=1)] = np.nan
 
-    # 'Adj Close vs Close'. We want Adj Close as we want to capture the return due to dividend payouts
-    # get rid of extra data like volume etc.
-    stockdata = stockdata[['Date', 'Close']]
-    stockdata.rename({'Close': 'price'}, axis=1, inplace=True)
+    totalcontrib = dfcontrib['contrib'].sum()
+    yearsinvested = (dfcontrib['Date'].iloc[-1] - dfcontrib['Date'].iloc[0]).days / 365.25
 
-    # We actually want to know what is the price of SPY on the days we contributed to the 401k portfolio.
-    # Direct comparison between unequal sized dataframes are not possible. Instead if we merge (inner=intersection)
-    # on the Date column then only the days of contribution will be extracted from the SPY data
+    dfsweep = pd.DataFrame({'finalvalue': r(finalvalue),
+                            'totreturn': r((finalvalue / totalcontrib - 1) * 100),
+                            'yoyreturn': r((np.exp(np.log(finalvalue / totalcontrib) / yearsinvested) - 1) * 100)},
+                           index=dfallocations.index)
 
-    dftickr = pd.merge(stockdata, dfcontrib, on=['Date'], how="inner")
-    dftickr['units'] = dfcontrib['contrib'] / dftickr['price']
-    dftickr['value'] = dftickr['units'].cumsum() * dftickr['price']
+    return dfsweep
 
-    # the merge leaves behind multiple indices. clean up the dataframe.
-    dftickr = dftickr[['Date', 'price', 'value']]
 
-    return dftickr
+def sweep(args):
+    """Evaluates the candidate allocations in args.allocations and saves the results to the output directory"""
+
+    settings = helpers.load_settings_stocks()
+    outputdir = settings['output_dir']
+
+    dfallocations = pd.read_csv(args.allocations)
+    if args.verbose:
+        print("Evaluating " + str(len(dfallocations)) + " allocations of " + str(dfallocations.shape[1]) + " funds")
+
+    portfolio = rt.Retirementportfolio(importquicken=True, verbose=args.verbose)
+    dfsweep = sweepallocations(portfolio, dfallocations, args.fetchincompletedata)
+    dfsweep = pd.concat([dfallocations, dfsweep], axis=1).sort_values('finalvalue', ascending=False)
+
+    sweepfile = outputdir + 'allocation_sweep.csv'
+    dfsweep.to_csv(sweepfile, index=False)
+    print("Allocation sweep is saved to " + sweepfile)
+    print(dfsweep.head(10))
 
 
 def simportfolio(args):
@@ -81,8 +211,6 @@ def simportfolio(args):
         print('Loading ' + mfnames)
     allocs = pd.read_csv(mfnames)
 
-    verbose = args.verbose
-
     fetchincompletedata = args.fetchincompletedata
 
     if args.ticker is None:
@@ -96,38 +224,10 @@ def simportfolio(args):
     # load the retirementportfolio class to begin the data import
     portfolio = rt.Retirementportfolio(importquicken=True)
 
-    # import the contributions to the portfolio. format: [Date, Contribution]
-    dfcontrib = portfolio.gencontrib()
-
-    # import the dividend payouts to the portfolio. format: [Date, name, dividend]
-    dfdividends = portfolio.getdividends()
-    dfdividends = dfdividends[['Date', 'dividend']]
-
-    # create empty dataframe to keep adding the price evolution of each ticker as a column
-    df = pd.DataFrame()
-    df['Date'] = dfcontrib['Date']
-
-    for ticker, f in zip(allocs['funds'], allocs['allocation']):
-        dftickr = getprices(ticker, dfcontrib, fetchincompletedata)
-        # The 'value' column contains the real information
-        df[ticker] = dftickr['value'] * f / 100
-        df = df.ffill(axis=0)
-
-    # compare portfolio performance to a single broad market ETF performance
-    dfstock = getprices(stock, dfcontrib)
-
-    # include dividend payouts from 401k
-    dfportfolio = df
-    dfportfolio.set_index('Date', inplace=True)
-    dfportfolio['portfoliovalue_nodiv'] = df.sum(axis=1)
-
-    dfportfolio = pd.merge(dfportfolio, dfdividends, on=['Date'], how='outer', sort=True)
-    dfportfolio['sum_div'] = dfportfolio['dividend'].cumsum().fillna(method='ffill').fillna(0)
-    dfportfolio['portfoliovalue_nodiv'] = dfportfolio['portfoliovalue_nodiv'].fillna(method='ffill')
-    dfportfolio['dividend'] = dfportfolio['dividend'].fillna(0)
-    dfportfolio['portfoliovalue_div'] = dfportfolio['portfoliovalue_nodiv'] + dfportfolio['sum_div']
-    dfportfolio = pd.merge(dfportfolio, dfstock, on=['Date'], how='outer', sort=True)
-    dfportfolio.rename({'value': stock + 'value'}, axis=1, inplace=True)
+    if args.history:
+        dfportfolio = simulatehistory(portfolio, stock, fetchincompletedata)
+    else:
+        dfportfolio = simulateallocation(portfolio, allocs, stock, fetchincompletedata)
 
     if verbose:
         print(dfportfolio)
@@ -141,4 +241,7 @@ def simportfolio(args):
 if __name__ == '__main__':
     helpers.initiate_logging()
     args = getargs()
-    simportfolio(args)
+    if args.allocations is None:
+        simportfolio(args)
+    else:
+        sweep(args)
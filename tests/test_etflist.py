@@ -0,0 +1,85 @@
+# tests of load_etf_data.etflist against recorded screener pages
+import datetime as dt
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('stockanalysis')
+pytest.importorskip('lxml')
+import load_etf_data
+
+
+def recordpages(source, pages=5, rows=3):
+    """Writes the screener pages etflist_<offset>.html, page k lists the tickers P<k>_0, P<k>_1, ..."""
+
+    os.makedirs(source, exist_ok=True)
+    symbols = []
+    for k in range(pages):
+        dfpage = pd.DataFrame({'Symbol': ['P' + str(k) + '_' + str(j) for j in range(rows)],
+                               'Name': ['ETF ' + str(k) + ' ' + str(j) for j in range(rows)]})
+        dfpage.to_html(os.path.join(source, 'etflist_' + str(k * 200) + '.html'), index=False)
+        symbols.extend(dfpage['Symbol'])
+    return symbols
+
+
+@pytest.fixture
+def inputdir(tmp_path, monkeypatch):
+    inputdir = tmp_path / 'input'
+    inputdir.mkdir()
+    monkeypatch.setattr(load_etf_data.helpers, 'load_settings_stocks', lambda: {'input_dir': str(inputdir) + '/'})
+    return inputdir
+
+
+def age(filename, days):
+    mtime = (dt.datetime.now() - dt.timedelta(days=days)).timestamp()
+    os.utime(filename, (mtime, mtime))
+
+
+def test_pages_in_order_saved_to_input_dir(tmp_path, inputdir):
+    symbols = recordpages(str(tmp_path / 'pages'))
+
+    tickerlist = load_etf_data.etflist(verbose=False, source=str(tmp_path / 'pages'))
+
+    assert list(tickerlist) == symbols
+    assert list(pd.read_csv(inputdir / 'etflist.csv')['Symbol']) == symbols
+    assert not os.path.exists(str(inputdir / 'etflist.csv') + '.tmp')
+
+
+def test_fresh_list_is_not_fetched(tmp_path, inputdir):
+    pd.DataFrame({'Symbol': ['OLD'], 'Name': ['Old ETF']}).to_csv(inputdir / 'etflist.csv', index=False)
+    age(inputdir / 'etflist.csv', 1)
+
+    # no recorded pages: a fetch would fail
+    tickerlist = load_etf_data.etflist(verbose=False, source=str(tmp_path / 'missing'))
+
+    assert list(tickerlist) == ['OLD']
+
+
+def test_stale_list_is_fetched_again(tmp_path, inputdir):
+    symbols = recordpages(str(tmp_path / 'pages'))
+    pd.DataFrame({'Symbol': ['OLD'], 'Name': ['Old ETF']}).to_csv(inputdir / 'etflist.csv', index=False)
+    age(inputdir / 'etflist.csv', 8)
+
+    tickerlist = load_etf_data.etflist(verbose=False, source=str(tmp_path / 'pages'))
+
+    assert list(tickerlist) == symbols
+    assert list(pd.read_csv(inputdir / 'etflist.csv')['Symbol']) == symbols
+
+
+def test_stale_list_is_used_when_the_fetch_fails(tmp_path, inputdir):
+    # the last page is missing
+    recordpages(str(tmp_path / 'pages'), pages=4)
+    pd.DataFrame({'Symbol': ['OLD'], 'Name': ['Old ETF']}).to_csv(inputdir / 'etflist.csv', index=False)
+    age(inputdir / 'etflist.csv', 8)
+
+    tickerlist = load_etf_data.etflist(verbose=False, source=str(tmp_path / 'pages'))
+
+    assert list(tickerlist) == ['OLD']
+
+
+def test_fetch_fails_without_a_list(tmp_path, inputdir):
+    recordpages(str(tmp_path / 'pages'), pages=4)
+
+    with pytest.raises((OSError, ValueError)):
+        load_etf_data.etflist(verbose=False, source=str(tmp_path / 'pages'))
@@ -0,0 +1,147 @@
+# tests of load_etf_data.prefetch against a local stand-in price server
+import datetime as dt
+import os
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('stockanalysis')
+import load_etf_data
+
+
+class PriceServer:
+    """
+    Serves '/<ticker>' as a small CSV. failures[ticker] = n answers 503 to the first n requests of a ticker, tickers
+    in dead always get 404. Every request is recorded with its time
+    """
+
+    def __init__(self, failures=None, dead=()):
+        self.failures = dict(failures or {})
+        self.dead = set(dead)
+        self.requests = []
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                tickr = self.path.strip('/')
+                with server.lock:
+                    server.requests.append((tickr, time.monotonic()))
+                    failing = server.failures.get(tickr, 0) > 0
+                    if failing:
+                        server.failures[tickr] -= 1
+                if tickr in server.dead:
+                    self.send_error(404)
+                elif failing:
+                    self.send_error(503)
+                else:
+                    body = b'Date,Close,Volume\n2024-01-02,10.0,100\n'
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:' + str(self.httpd.server_address[1]) + '/'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def fetch(self, tickr):
+        with urllib.request.urlopen(self.url + tickr, timeout=5) as response:
+            return response.read()
+
+    def fetched(self, tickr):
+        return sum(1 for t, _ in self.requests if t == tickr)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    servers = []
+
+    def start(**kwargs):
+        servers.append(PriceServer(**kwargs))
+        return servers[-1]
+
+    yield start
+    for s in servers:
+        s.close()
+
+
+def test_retries_with_backoff(server):
+    s = server(failures={'B': 2})
+    failed = load_etf_data.prefetch(['A', 'B'], s.fetch, workers=2, retries=3, backoff=0.01, verbose=False)
+
+    assert failed == []
+    assert s.fetched('A') == 1
+    assert s.fetched('B') == 3
+
+
+def test_gives_up_after_retries(server):
+    s = server(dead=['DEAD'])
+    failed = load_etf_data.prefetch(['A', 'DEAD'], s.fetch, workers=2, retries=2, backoff=0.01, verbose=False)
+
+    assert failed == ['DEAD']
+    assert s.fetched('DEAD') == 3
+
+
+def test_rate_limit(server):
+    s = server()
+    tickers = ['T' + str(j) for j in range(10)]
+    load_etf_data.prefetch(tickers, s.fetch, workers=8, requests=5, window=1, verbose=False)
+
+    times = sorted(t for _, t in s.requests)
+    # the bucket starts full: 5 requests at once, then one every 0.2 seconds
+    assert all(times[5 + j] - times[0] >= 0.2 * (j + 1) - 0.05 for j in range(len(times) - 5))
+
+
+def test_resumes_interrupted_run(server, tmp_path):
+    s = server()
+    checkpoint = str(tmp_path / 'checkpoint.txt')
+
+    def interrupted(tickr):
+        if tickr == 'C':
+            raise KeyboardInterrupt
+        s.fetch(tickr)
+
+    with pytest.raises(KeyboardInterrupt):
+        load_etf_data.prefetch(['A', 'B', 'C', 'D'], interrupted, workers=1, checkpoint=checkpoint, verbose=False)
+    assert os.path.exists(checkpoint)
+
+    failed = load_etf_data.prefetch(['A', 'B', 'C', 'D'], s.fetch, workers=1, checkpoint=checkpoint, verbose=False)
+
+    assert failed == []
+    assert [s.fetched(tickr) for tickr in 'ABCD'] == [1, 1, 1, 1]
+    assert not os.path.exists(checkpoint)
+
+
+def test_failed_ticker_does_not_block_next_run(server, tmp_path):
+    s = server(dead=['DEAD'])
+    checkpoint = str(tmp_path / 'checkpoint.txt')
+
+    for run in range(2):
+        load_etf_data.prefetch(['A', 'B', 'DEAD'], s.fetch, retries=0, checkpoint=checkpoint, verbose=False)
+        assert not os.path.exists(checkpoint)
+
+    assert s.fetched('A') == 2
+    assert s.fetched('B') == 2
+
+
+def test_ignores_checkpoint_of_another_day(server, tmp_path):
+    s = server()
+    checkpoint = str(tmp_path / 'checkpoint.txt')
+    yesterday = (dt.date.today() - dt.timedelta(days=1)).isoformat()
+    with open(checkpoint, 'w') as f:
+        f.write('# ' + yesterday + '\nA\n')
+
+    load_etf_data.prefetch(['A', 'B'], s.fetch, checkpoint=checkpoint, verbose=False)
+
+    assert s.fetched('A') == 1